@@ -0,0 +1,121 @@
+"""
+Allele frequencies from a VCF file (e.g. of the 1000 Genomes Project)
+
+The table is a dict: chrom -> {(pos, alt): frequency}, with pos 1-indexed
+and any 'chr' prefix stripped from chrom. Frequencies are computed from
+the AC and AN annotations of the INFO field. A table can be pickled to a
+file once read, for faster loading next time.
+"""
+from __future__ import with_statement, division
+
+import os
+import sys
+import cPickle
+
+from collections import defaultdict
+
+from silva import maybe_gzip_open
+from silva.vcf import split_fields
+
+
+def read_af_table(filename, optfile=None):
+    """Read the table from a VCF file, saving it to optfile (pickled) if
+    given and not already there
+    """
+    data = defaultdict(dict)
+    with maybe_gzip_open(filename) as ifp:
+        for line in ifp:
+            if not line.strip() or line.startswith('#'): continue
+            # Genotype columns are not split
+            tokens = split_fields(line, 8)[0]
+            chrom, pos = tokens[:2]
+            alt = tokens[4].split(',')[0]
+            info = tokens[7]
+            # Split AC and AN from INFO field
+            fields = info.split(';')
+            fields.sort()
+            ac = an = None
+            for field in fields:
+                if field.startswith('AC='):
+                    ac = int(field.split('=')[1])
+                    if an is not None:
+                        break
+                elif field.startswith('AN='):
+                    an = int(field.split('=')[1])
+                    if ac is not None:
+                        break
+
+            assert ac is not None and an is not None, \
+                   "Error: entry with AC and AN: %s" % line
+
+            data[chrom.lstrip('chr')][(int(pos), alt)] = float(ac) / an
+
+    if optfile and not os.path.isfile(optfile):
+        print >>sys.stderr, "Saving optimized table to:", optfile
+        with maybe_gzip_open(optfile, 'wb') as ofp:
+            cPickle.dump(data, ofp, cPickle.HIGHEST_PROTOCOL)
+
+    return data
+
+
+def load_af_table(filename, optfile=None):
+    """Load the table from optfile if it exists, otherwise from filename"""
+    if optfile and os.path.isfile(optfile):
+        print >>sys.stderr, "Loading optimized table from:", optfile
+        with maybe_gzip_open(optfile, 'rb') as ifp:
+            return cPickle.load(ifp)
+    else:
+        print >>sys.stderr, "Loading table from:", filename
+        return read_af_table(filename, optfile)
+
+
+def format_af(table, chrom, pos, alt):
+    """Return the frequency of alt at pos (1-indexed) on chrom, formatted
+    as by 1000gp.py ('.' if not found)
+    """
+    try:
+        return '%.4f' % table[chrom.lstrip('chr')][(int(pos), alt)]
+    except (IndexError, KeyError):
+        return '.'
+
+
+def af_in_range(af, af_min, af_max):
+    """Is a formatted frequency (unknown counting as 0) in [af_min, af_max]?"""
+    value = 0 if af == '.' else float(af)
+    return af_min <= value <= af_max
+
+
+def run_tests():
+    import shutil
+    from tempfile import mkdtemp
+    tmpdir = mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'test.vcf')
+        with open(filename, 'w') as ofp:
+            print >>ofp, '##fileformat=VCFv4.1'
+            print >>ofp, '1\t5\t.\tA\tG\t.\t.\tAN=8;AC=2'
+            # Multiple alts: keyed by the first
+            print >>ofp, 'chr1\t6\t.\tA\tC,T\t.\t.\tDP=3;AC=1;AN=3\tGT\t0/1'
+        optfile = os.path.join(tmpdir, 'test.pkl')
+        table = load_af_table(filename, optfile)
+        assert table == {'1': {(5, 'G'): 0.25, (6, 'C'): 1 / 3}}
+        # Saved, and loaded from there the next time
+        assert os.path.isfile(optfile)
+        assert load_af_table(filename, optfile) == table
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # As printed by 1000gp.py, '.' if not found
+    assert format_af(table, 'chr1', '5', 'G') == '0.2500'
+    assert format_af(table, '1', 6, 'C') == '0.3333'
+    assert format_af(table, '1', 6, 'T') == '.'
+    assert format_af(table, '2', 5, 'G') == '.'
+
+    # As the allele frequency filter of silva-preprocess: unknown counts as
+    # 0, and the bounds are inclusive
+    assert af_in_range('.', 0, 0.05) and not af_in_range('.', 0.01, 0.05)
+    assert af_in_range('0.0500', 0, 0.05) and af_in_range('0.0100', 0.01, 1)
+    assert not af_in_range('0.0501', 0, 0.05)
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,103 @@
+"""
+Writing BGZF (blocked gzip) files, as written by bgzip
+
+A BGZF file is a series of gzip members, each holding at most 64 kB of
+data, so it can be read with zcat or gzip.open, indexed by tabix, and
+written in pieces: the blocks of separately compressed data can simply be
+concatenated, with EOF_BLOCK at the very end.
+"""
+from __future__ import with_statement, division
+
+import zlib
+import struct
+
+# Uncompressed bytes per block (as bgzip), leaving room for the block
+# to grow when data does not compress
+BLOCK_SIZE = 0xff00
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = '1f8b08040000000000ff0600424302001b0003000000000000000000' \
+    .decode('hex')
+
+
+def compress_block(data, level=6):
+    """Return data (at most BLOCK_SIZE bytes) as one BGZF block"""
+    assert len(data) <= BLOCK_SIZE
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    # gzip header with the 'BC' extra field: total block size - 1
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                         66, 67, 2, len(deflated) + 25)
+    trailer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + deflated + trailer
+
+
+def compress(data, level=6):
+    """Return data as BGZF blocks (without EOF_BLOCK)"""
+    return ''.join([compress_block(data[i:i + BLOCK_SIZE], level)
+                    for i in xrange(0, len(data), BLOCK_SIZE)])
+
+
+class BgzfWriter(object):
+    """Writes a BGZF file to a file object, a block at a time"""
+    def __init__(self, fileobj, level=6):
+        self._fileobj = fileobj
+        self._level = level
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BLOCK_SIZE:
+            data = ''.join(self._buffer)
+            n_full = len(data) - len(data) % BLOCK_SIZE
+            self._fileobj.write(compress(data[:n_full], self._level))
+            self._buffer = [data[n_full:]]
+            self._buffered = len(data) - n_full
+
+    def flush(self):
+        """Write any buffered data as a (short) block"""
+        if self._buffered:
+            self._fileobj.write(compress(''.join(self._buffer), self._level))
+        self._buffer = []
+        self._buffered = 0
+
+    def write_blocks(self, blocks):
+        """Write data already compressed with compress()"""
+        self.flush()
+        self._fileobj.write(blocks)
+
+    def close(self):
+        """Write any buffered data and EOF_BLOCK (the file object is left
+        open)
+        """
+        self.flush()
+        self._fileobj.write(EOF_BLOCK)
+
+
+def run_tests():
+    from gzip import GzipFile
+    from cStringIO import StringIO
+
+    def gunzip(blocks):
+        return GzipFile(fileobj=StringIO(blocks)).read()
+
+    data = ''.join(['%d\tACGT\n' % i for i in xrange(20000)])
+    assert len(data) > 2 * BLOCK_SIZE
+    blocks = compress(data)
+    assert gunzip(blocks + EOF_BLOCK) == data
+    assert gunzip(EOF_BLOCK) == ''
+
+    # Written in pieces, with blocks compressed elsewhere in between
+    ofp = StringIO()
+    writer = BgzfWriter(ofp)
+    for i in xrange(0, len(data), 1000):
+        writer.write(data[i:i + 1000])
+    writer.write_blocks(compress('more\n'))
+    writer.write('last\n')
+    writer.close()
+    assert gunzip(ofp.getvalue()) == data + 'more\nlast\n'
+    assert ofp.getvalue().endswith(EOF_BLOCK)
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,171 @@
+"""
+Sequence context of a mutation in a transcript
+
+The context is written by 'synonymous.py annotate' in one of two forms.
+The full form is the whole pre-mRNA, with splice junctions marked by pipes
+and the mutation in brackets: ACT|ACGCACA[G/T]|ACAACA
+
+The compact form keeps only the sequence near the mutation, plus the
+lengths of all blocks of the pre-mRNA:
+
+@LENGTHS;INDEX;PRE_START;PRE_WINDOW;MRNA_START;MRNA_WINDOW
+
+LENGTHS: comma-separated lengths of the blocks of the pre-mRNA between
+  splice junctions (exon, intron, exon, ...)
+INDEX: the block with the mutation (0-indexed)
+PRE_WINDOW: the pre-mRNA from offset PRE_START (0-indexed), covering the
+  mutated block and FLANK bases either side of it, with the mutation in
+  brackets
+MRNA_WINDOW: the mRNA (the exons, joined) from offset MRNA_START, covering
+  FLANK bases either side of the mutation (empty if it is in an intron)
+
+Its size depends on the mutated exon, not on the length of the gene.
+MutationContext reads either form.
+"""
+from __future__ import with_statement, division
+
+from bisect import bisect_right
+
+# Bases of context kept either side of the mutated block (pre-mRNA) or of
+# the mutation (mRNA)
+FLANK = 100
+COMPACT_PREFIX = '@'
+
+
+class MutationContext(object):
+    """The context of one mutation (see above); sequence is on the
+    transcript strand
+    """
+    def __init__(self, lengths, index, pre_start, pre_window, mrna_start,
+                 mrna_window):
+        self.lengths = lengths
+        self.index = index
+        self.pre_start = pre_start
+        self.pre_window = pre_window
+        self.mrna_start = mrna_start
+        self.mrna_window = mrna_window
+
+    @classmethod
+    def from_premrna(cls, premrna, edges, offset, ref, alt, flank=FLANK):
+        """Return the compact context of ref -> alt at offset (0-indexed)
+        in premrna (transcript strand)
+
+        edges: sorted offsets of the splice junctions, from 0 to len(premrna)
+        """
+        assert flank > 0
+        lengths = [end - start for start, end in zip(edges[:-1], edges[1:])]
+        index = bisect_right(edges, offset) - 1
+        mutation = '[%s/%s]' % (ref, alt)
+        pre_start = max(edges[index] - flank, 0)
+        pre_end = min(edges[index + 1] + flank, len(premrna))
+        pre_window = premrna[pre_start:offset] + mutation + \
+            premrna[offset + 1:pre_end]
+        if index % 2:
+            # An intron, so not in the mRNA
+            return cls(lengths, index, pre_start, pre_window, 0, '')
+
+        # Up to flank bases of the mRNA before the mutation, exon by exon
+        before = [premrna[max(edges[index], offset - flank):offset]]
+        n_before = len(before[0])
+        i = index - 2
+        while n_before < flank and i >= 0:
+            start = max(edges[i], edges[i + 1] - (flank - n_before))
+            before.append(premrna[start:edges[i + 1]])
+            n_before += edges[i + 1] - start
+            i -= 2
+        before.reverse()
+
+        # and after it
+        end = min(edges[index + 1], offset + 1 + flank)
+        after = [premrna[offset + 1:end]]
+        n_after = len(after[0])
+        i = index + 2
+        while n_after < flank and i < len(lengths):
+            end = min(edges[i + 1], edges[i] + (flank - n_after))
+            after.append(premrna[edges[i]:end])
+            n_after += end - edges[i]
+            i += 2
+
+        mrna_offset = sum(lengths[0:index:2]) + offset - edges[index]
+        return cls(lengths, index, pre_start, pre_window,
+                   mrna_offset - n_before,
+                   ''.join(before) + mutation + ''.join(after))
+
+    @classmethod
+    def parse(cls, seq):
+        """Read a context in either the full or the compact form"""
+        seq = seq.strip()
+        if seq.startswith(COMPACT_PREFIX):
+            lengths, index, pre_start, pre_window, mrna_start, mrna_window = \
+                seq[len(COMPACT_PREFIX):].split(';')
+            assert pre_window.count('/') == 1, \
+                "Expected one mutation in: %s" % seq[:20]
+            return cls([int(length) for length in lengths.split(',')],
+                       int(index), int(pre_start), pre_window,
+                       int(mrna_start), mrna_window)
+
+        assert seq.count('/') == 1, "Expected one mutation in: %s" % seq[:20]
+        chunks = seq.split('|')
+        index = [i for i, chunk in enumerate(chunks) if '/' in chunk][0]
+        lengths = [len(chunk) for chunk in chunks]
+        lengths[index] -= len('[/]') + 1  # Brackets and alt
+        mrna = ''.join(chunks[::2]) if index % 2 == 0 else ''
+        return cls(lengths, index, 0, ''.join(chunks), 0, mrna)
+
+    def __str__(self):
+        lengths = ','.join([str(length) for length in self.lengths])
+        return '%s%s;%d;%d;%s;%d;%s' % \
+            (COMPACT_PREFIX, lengths, self.index, self.pre_start, self.pre_window, self.mrna_start,
+             self.mrna_window)
+
+    def _block_range(self):
+        """Return the start and end of the mutated block in pre_window"""
+        start = sum(self.lengths[:self.index]) - self.pre_start
+        return start, start + self.lengths[self.index] + len('[/]') + 1
+
+    def block(self):
+        """Return the mutated block (e.g. the exon): AAGA[C/G]TCG"""
+        start, end = self._block_range()
+        return self.pre_window[start:end]
+
+    def premrna(self):
+        """Return the pre-mRNA around the mutation: AAGTTTAGA[C/G]TCGGTA"""
+        return self.pre_window
+
+    def mrna(self):
+        """Return the mRNA around the mutation (empty if in an intron)"""
+        return self.mrna_window
+
+    def flanks(self, before, after):
+        """Return up to before bases of the pre-mRNA before the mutated
+        block, and up to after bases after it (at most FLANK of either)
+        """
+        start, end = self._block_range()
+        return self.pre_window[max(start - before, 0):start], \
+            self.pre_window[end:end + after]
+
+    def premrna_lengths(self):
+        """Return the number of bases of the pre-mRNA before and after
+        the mutation
+        """
+        before = self.pre_start + self.pre_window.index('[')
+        return before, sum(self.lengths) - before - 1
+
+    def block_lengths(self):
+        """Return the number of bases of the mutated block before and after
+        the mutation
+        """
+        before = self.pre_start + self.pre_window.index('[') - \
+            sum(self.lengths[:self.index])
+        return before, self.lengths[self.index] - before - 1
+
+    def mrna_lengths(self):
+        """Return the number of bases of the exons (the blocks at even
+        indexes) before and after the mutation, counting the rest of the
+        mutated block as exon
+        """
+        in_before, in_after = self.block_lengths()
+        before = sum(self.lengths[0:self.index:2])
+        if self.index % 2 == 0:
+            before += in_before
+        return before, in_after + sum(self.lengths[self.index + 2::2])
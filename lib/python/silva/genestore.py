@@ -0,0 +1,290 @@
+"""
+Columnar, memory-mapped store of gene models
+
+A gene store is a directory with one .npy array per transcript column
+(coordinates, names, ...), the exon coordinates of all transcripts
+concatenated, and genomic sequence packed into a single blob (seq.blob).
+Overlapping transcripts (e.g. the isoforms of a gene) can share one span
+of the blob, each recording only where its own sequence starts.
+Arrays are loaded with mmap_mode='r' and the blob is memory-mapped, so
+opening a store reads almost nothing, and concurrent processes share the
+same pages of the page cache.
+
+Transcripts are stored sorted by gene, so the transcripts of a gene are
+a contiguous range of rows. An IntervalIndex of their CDS (cds_index.*),
+with rows as ids, is stored alongside, as are the transcript accessions in
+sorted order (tx_sorted.npy) with their rows (tx_order.npy), for lookups by
+accession.
+"""
+from __future__ import with_statement, division
+
+import os
+import mmap
+import shutil
+
+import numpy as np
+
+from silva.intervals import IntervalIndex
+
+STORE_VERSION = 3
+VERSION_FILENAME = 'VERSION'
+SEQ_FILENAME = 'seq.blob'
+
+# Name -> dtype of each per-transcript column
+TX_COLUMNS = [('gene', 'S'), ('tx', 'S'), ('chrom', 'S'), ('strand', 'S1'),
+              ('tx_start', np.int64), ('tx_end', np.int64),
+              ('cds_start', np.int64), ('cds_end', np.int64),
+              ('exon_offset', np.int64), ('exon_count', np.int32),
+              ('seq_offset', np.int64)]
+EXON_COLUMNS = [('exon_starts', np.int64), ('exon_ends', np.int64)]
+
+
+def is_gene_store(dirname):
+    """Is dirname a complete gene store of the current version?"""
+    try:
+        with open(os.path.join(dirname, VERSION_FILENAME)) as ifp:
+            return int(ifp.read()) == STORE_VERSION
+    except (IOError, ValueError):
+        return False
+
+
+class GeneStoreWriter(object):
+    """Writes a gene store, one transcript at a time
+
+    Sequences are streamed to the blob as they are added; the columns are
+    written by close(). A transcript either brings its own sequence, or
+    lies within the span last added with add_span. The store is written
+    to dirname.tmp and renamed to dirname once complete.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._tmp_dirname = dirname.rstrip('/') + '.tmp'
+        if os.path.isdir(self._tmp_dirname):
+            shutil.rmtree(self._tmp_dirname)
+        os.makedirs(self._tmp_dirname)
+        self._seq_file = open(os.path.join(self._tmp_dirname, SEQ_FILENAME),
+                              'wb')
+        self._seq_offset = 0
+        self._span = None
+        self._rows = []
+
+    def add_span(self, chrom, start, seq):
+        """Add genomic (+ strand) sequence of chrom, starting at start
+        (0-indexed), for the transcripts that follow
+        """
+        self._span = (chrom, start, start + len(seq), self._seq_offset)
+        self._seq_file.write(seq)
+        self._seq_offset += len(seq)
+
+    def add(self, record, seq=None):
+        """Add a transcript
+
+        record: dict with the fields gene, tx, chrom, strand, tx_start,
+          tx_end, cds_start, cds_end, exon_starts and exon_ends
+        seq: genomic (+ strand) sequence from tx_start to tx_end, if the
+          transcript is not within the last span (see add_span)
+        """
+        tx_start = int(record['tx_start'])
+        tx_end = int(record['tx_end'])
+        if seq is not None:
+            assert len(seq) == tx_end - tx_start, \
+                "Sequence length != transcript length: %s" % record['tx']
+            self.add_span(record['chrom'], tx_start, seq)
+
+        chrom, span_start, span_end, span_offset = self._span
+        assert chrom == record['chrom'] and \
+            span_start <= tx_start <= tx_end <= span_end, \
+            "Transcript outside of sequence span: %s" % record['tx']
+        self._rows.append((record['gene'], record['tx'], record['chrom'],
+                           record['strand'], tx_start, tx_end,
+                           int(record['cds_start']), int(record['cds_end']),
+                           [int(x) for x in record['exon_starts']],
+                           [int(x) for x in record['exon_ends']],
+                           span_offset + tx_start - span_start))
+
+    def _save(self, name, values, dtype):
+        if dtype == 'S':
+            # numpy picks the width of the longest string
+            array = np.array(values, dtype=str)
+        else:
+            array = np.array(values, dtype=dtype)
+        np.save(os.path.join(self._tmp_dirname, name + '.npy'), array)
+
+    def close(self):
+        """Write the columns and move the store into place"""
+        self._seq_file.close()
+        # Stable sort by gene, keeping the input order within a gene
+        self._rows.sort(key=lambda row: row[0])
+        columns = dict((name, []) for name, dtype in TX_COLUMNS)
+        exon_starts = []
+        exon_ends = []
+        for (gene, tx, chrom, strand, tx_start, tx_end, cds_start, cds_end,
+             starts, ends, seq_offset) in self._rows:
+            columns['gene'].append(gene)
+            columns['tx'].append(tx)
+            columns['chrom'].append(chrom)
+            columns['strand'].append(strand)
+            columns['tx_start'].append(tx_start)
+            columns['tx_end'].append(tx_end)
+            columns['cds_start'].append(cds_start)
+            columns['cds_end'].append(cds_end)
+            columns['exon_offset'].append(len(exon_starts))
+            columns['exon_count'].append(len(starts))
+            columns['seq_offset'].append(seq_offset)
+            exon_starts.extend(starts)
+            exon_ends.extend(ends)
+
+        for name, dtype in TX_COLUMNS:
+            self._save(name, columns[name], dtype)
+        self._save('exon_starts', exon_starts, np.int64)
+        self._save('exon_ends', exon_ends, np.int64)
+        cds_index = IntervalIndex.build(columns['chrom'], columns['cds_start'],
+                                        columns['cds_end'])
+        cds_index.save(self._tmp_dirname, 'cds_index')
+        txs = np.array(columns['tx'], dtype=str)
+        tx_order = np.argsort(txs, kind='mergesort')
+        self._save('tx_sorted', txs[tx_order], 'S')
+        self._save('tx_order', tx_order, np.int64)
+        with open(os.path.join(self._tmp_dirname, VERSION_FILENAME), 'w') \
+                as ofp:
+            ofp.write('%d\n' % STORE_VERSION)
+
+        if os.path.isdir(self.dirname):
+            shutil.rmtree(self.dirname)
+        os.rename(self._tmp_dirname, self.dirname)
+        self._rows = []
+
+
+class GeneStore(object):
+    """Read-only view of a gene store written by GeneStoreWriter"""
+    def __init__(self, dirname):
+        assert is_gene_store(dirname), \
+            "Not a gene store (version %d): %s" % (STORE_VERSION, dirname)
+        self.dirname = dirname
+        self.columns = {}
+        for name, dtype in TX_COLUMNS + EXON_COLUMNS:
+            filename = os.path.join(dirname, name + '.npy')
+            self.columns[name] = np.load(filename, mmap_mode='r')
+        self.cds_index = IntervalIndex.load(dirname, 'cds_index')
+        self._tx_sorted = np.load(os.path.join(dirname, 'tx_sorted.npy'),
+                                  mmap_mode='r')
+        self._tx_order = np.load(os.path.join(dirname, 'tx_order.npy'),
+                                 mmap_mode='r')
+
+        genes = self.columns['gene']
+        if len(genes):
+            # First row of each gene, and the end of the last one
+            firsts = np.flatnonzero(genes[1:] != genes[:-1]) + 1
+            self._gene_rows = np.concatenate(([0], firsts, [len(genes)]))
+        else:
+            self._gene_rows = np.zeros(1, dtype=np.int64)
+        self._gene_names = np.array(genes[self._gene_rows[:-1]])
+
+        seq_filename = os.path.join(dirname, SEQ_FILENAME)
+        if os.path.getsize(seq_filename):
+            with open(seq_filename, 'rb') as ifp:
+                self._seq = mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._seq = ''
+
+    def __len__(self):
+        """Number of transcripts"""
+        return len(self.columns['gene'])
+
+    def gene_names(self):
+        return [str(name) for name in self._gene_names]
+
+    def _gene_index(self, gene):
+        i = np.searchsorted(self._gene_names, gene)
+        if i < len(self._gene_names) and self._gene_names[i] == gene:
+            return i
+        return None
+
+    def __contains__(self, gene):
+        return self._gene_index(gene) is not None
+
+    def rows(self, gene):
+        """Return the range of rows of gene's transcripts (maybe empty)"""
+        i = self._gene_index(gene)
+        if i is None:
+            return xrange(0)
+        return xrange(self._gene_rows[i], self._gene_rows[i + 1])
+
+    def tx_rows(self, tx):
+        """Return the rows of transcripts with accession tx (maybe several,
+        or none), in row order
+        """
+        lo = np.searchsorted(self._tx_sorted, tx, 'left')
+        hi = np.searchsorted(self._tx_sorted, tx, 'right')
+        return sorted(int(row) for row in self._tx_order[lo:hi])
+
+    def records(self, rows):
+        """Return a list of dicts, one per row of a contiguous range of rows,
+        with the fields given to GeneStoreWriter.add (and seq_offset)
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+        first, last = rows[0], rows[-1] + 1
+        columns = dict((name, self.columns[name][first:last].tolist())
+                       for name, dtype in TX_COLUMNS)
+        exon_starts = self.columns['exon_starts']
+        exon_ends = self.columns['exon_ends']
+        records = []
+        for i in xrange(last - first):
+            record = dict((name, columns[name][i])
+                          for name, dtype in TX_COLUMNS)
+            exon_offset = record.pop('exon_offset')
+            exons = slice(exon_offset, exon_offset + record.pop('exon_count'))
+            record['exon_starts'] = exon_starts[exons].tolist()
+            record['exon_ends'] = exon_ends[exons].tolist()
+            records.append(record)
+        return records
+
+    def seq(self, row):
+        """Return the genomic (+ strand) sequence of row's transcript"""
+        offset = int(self.columns['seq_offset'][row])
+        size = int(self.columns['tx_end'][row] - self.columns['tx_start'][row])
+        return self._seq[offset:offset + size]
+
+
+def run_tests():
+    from tempfile import mkdtemp
+    tmpdir = mkdtemp()
+    try:
+        dirname = os.path.join(tmpdir, 'test.genes')
+        writer = GeneStoreWriter(dirname)
+        tx1 = {'gene': 'B', 'tx': 'tx1', 'chrom': '1', 'strand': '+',
+               'tx_start': 10, 'tx_end': 20, 'cds_start': 12, 'cds_end': 18,
+               'exon_starts': [10, 16], 'exon_ends': [14, 20]}
+        tx2 = dict(tx1, gene='A', tx='tx2', tx_start=12, tx_end=16,
+                   cds_start=12, cds_end=16, exon_starts=[12],
+                   exon_ends=[16])
+        # Both within one span of sequence
+        writer.add_span('1', 10, 'ACGTACGTAC')
+        writer.add(tx1)
+        writer.add(tx2)
+        writer.add(dict(tx2, gene='C'))
+        writer.close()
+        assert is_gene_store(dirname)
+        assert not os.path.exists(dirname + '.tmp')
+
+        store = GeneStore(dirname)
+        assert len(store) == 3
+        # Sorted by gene
+        assert store.gene_names() == ['A', 'B', 'C']
+        assert 'B' in store and 'D' not in store
+        assert list(store.rows('B')) == [1] and list(store.rows('D')) == []
+        # Accessions may be shared by several rows
+        assert store.tx_rows('tx2') == [0, 2] and store.tx_rows('tx1') == [1]
+        assert store.tx_rows('tx0') == [] and store.tx_rows('tx3') == []
+        record, = store.records(store.rows('B'))
+        assert record.pop('seq_offset') == 0 and record == tx1
+        assert store.seq(0) == 'GTAC' and store.seq(1) == 'ACGTACGTAC'
+        assert sorted(store.cds_index.query('1', 12)) == [0, 1, 2]
+        assert list(store.cds_index.query('1', 17)) == [1]
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,217 @@
+"""
+Static index of intervals on chromosomes, for overlap queries
+
+Intervals are sorted by start within each chromosome, alongside the
+running maximum of their ends. The intervals containing a position are
+then those between the first whose running maximum end passes the
+position and the last that starts at or before it, found with two binary
+searches and a vectorized check of the candidates in between.
+
+The index is a handful of flat numpy arrays, so it can be saved next to
+other data and loaded with mmap_mode='r'.
+"""
+from __future__ import with_statement, division
+
+import os
+
+import numpy as np
+
+ARRAYS = ['chroms', 'bounds', 'starts', 'ends', 'max_ends', 'ids']
+
+
+class IntervalIndex(object):
+    """Intervals are 0-indexed, half-open: [start, end)
+    Each interval has an integer id, returned by queries
+    """
+    def __init__(self, chroms, bounds, starts, ends, max_ends, ids):
+        """Use IntervalIndex.build or IntervalIndex.load"""
+        self.chroms = chroms
+        self.bounds = bounds
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends
+        self.ids = ids
+        self._chrom_index = dict((str(chrom), i)
+                                 for i, chrom in enumerate(chroms))
+
+    @classmethod
+    def build(cls, chroms, starts, ends, ids=None):
+        """Index intervals given as parallel sequences
+        ids default to the position of each interval in the sequences
+        """
+        chroms = np.array(chroms, dtype=str)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if ids is None:
+            ids = np.arange(len(starts), dtype=np.int64)
+        else:
+            ids = np.asarray(ids, dtype=np.int64)
+
+        order = np.lexsort((starts, chroms))
+        chroms, starts, ends, ids = \
+            chroms[order], starts[order], ends[order], ids[order]
+        if len(chroms):
+            firsts = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+            bounds = np.concatenate(([0], firsts, [len(chroms)]))
+        else:
+            bounds = np.zeros(1, dtype=np.int64)
+
+        max_ends = np.empty_like(ends)
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            max_ends[first:last] = np.maximum.accumulate(ends[first:last])
+
+        return cls(chroms[bounds[:-1]], bounds.astype(np.int64), starts, ends,
+                   max_ends, ids)
+
+    def save(self, dirname, prefix):
+        """Save as dirname/PREFIX.NAME.npy files"""
+        for name in ARRAYS:
+            np.save(os.path.join(dirname, '%s.%s.npy' % (prefix, name)),
+                    getattr(self, name))
+
+    @classmethod
+    def load(cls, dirname, prefix, mmap_mode='r'):
+        arrays = [np.load(os.path.join(dirname, '%s.%s.npy' % (prefix, name)),
+                          mmap_mode=mmap_mode)
+                  for name in ARRAYS]
+        return cls(*arrays)
+
+    @classmethod
+    def exists(cls, dirname, prefix):
+        return all(os.path.isfile(os.path.join(dirname, '%s.%s.npy' %
+                                               (prefix, name)))
+                   for name in ARRAYS)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _chrom_range(self, chrom):
+        i = self._chrom_index.get(chrom)
+        if i is None:
+            return 0, 0
+        return self.bounds[i], self.bounds[i + 1]
+
+    def query(self, chrom, pos):
+        """Return an array of the ids of intervals containing pos
+        (0-indexed) on chrom
+        """
+        first, last = self._chrom_range(chrom)
+        if first == last:
+            return self.ids[:0]
+        lo = first + np.searchsorted(self.max_ends[first:last], pos, 'right')
+        hi = first + np.searchsorted(self.starts[first:last], pos, 'right')
+        if lo >= hi:
+            return self.ids[:0]
+        return self.ids[lo:hi][self.ends[lo:hi] > pos]
+
+    def query_batch(self, chrom, positions):
+        """Return a list with an array of the ids of intervals containing
+        each of positions (0-indexed) on chrom
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        first, last = self._chrom_range(chrom)
+        if first == last:
+            return [self.ids[:0]] * len(positions)
+        los = first + np.searchsorted(self.max_ends[first:last], positions,
+                                      'right')
+        his = first + np.searchsorted(self.starts[first:last], positions,
+                                      'right')
+        results = []
+        for pos, lo, hi in zip(positions, los, his):
+            if lo >= hi:
+                results.append(self.ids[:0])
+            else:
+                results.append(self.ids[lo:hi][self.ends[lo:hi] > pos])
+        return results
+
+
+class IntervalSweep(object):
+    """Finds the intervals of an IntervalIndex containing positions that
+    are given in sorted order (chromosome by chromosome), by walking the
+    sorted intervals alongside them and keeping only those still open
+
+    Once positions arrive out of order (a chromosome seen before, or a
+    position before the previous one), sorted is set to False and all
+    further queries go to the index instead.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.sorted = True
+        self._chrom = None
+        self._seen_chroms = set()
+        self._pos = None
+        self._next = self._last = 0
+        self._open = []
+
+    def _start_chrom(self, chrom):
+        self._seen_chroms.add(chrom)
+        self._chrom = chrom
+        self._pos = None
+        self._next, self._last = self.index._chrom_range(chrom)
+        self._open = []
+
+    def query(self, chrom, pos):
+        """Return a list of the ids of intervals containing pos (0-indexed)
+        on chrom
+        """
+        if self.sorted:
+            if chrom != self._chrom:
+                if chrom in self._seen_chroms:
+                    self.sorted = False
+                else:
+                    self._start_chrom(chrom)
+            elif pos < self._pos:
+                self.sorted = False
+
+        if not self.sorted:
+            return list(self.index.query(chrom, pos))
+
+        self._pos = pos
+        starts = self.index.starts
+        while self._next < self._last and starts[self._next] <= pos:
+            self._open.append(self._next)
+            self._next += 1
+
+        ends = self.index.ends
+        self._open = [i for i in self._open if ends[i] > pos]
+        ids = self.index.ids
+        return [ids[i] for i in self._open]
+
+
+def run_tests():
+    from random import Random
+    rand = Random(0)
+    intervals = []
+    for i in range(200):
+        start = rand.randint(0, 1000)
+        intervals.append((rand.choice('12'), start,
+                          start + rand.randint(1, 200)))
+    index = IntervalIndex.build(*zip(*intervals))
+    assert len(index) == len(intervals)
+
+    # Queries agree with brute force, including on unknown chromosomes
+    positions = range(-1, 1250)
+    for chrom in ['1', '2', '3']:
+        batch = index.query_batch(chrom, positions)
+        for pos, ids in zip(positions, batch):
+            expected = sorted([i for i, (c, start, end) in enumerate(intervals)
+                               if c == chrom and start <= pos < end])
+            assert sorted(index.query(chrom, pos)) == expected
+            assert sorted(ids) == expected
+
+    # Sweeping sorted positions agrees with the index, and falls back to
+    # it once they are out of order
+    sweep = IntervalSweep(index)
+    for chrom in ['2', '3', '1']:
+        for pos in positions:
+            assert sorted(sweep.query(chrom, pos)) == \
+                sorted(index.query(chrom, pos))
+    assert sweep.sorted
+    assert sorted(sweep.query('2', 500)) == sorted(index.query('2', 500))
+    assert not sweep.sorted
+
+    empty = IntervalIndex.build([], [], [])
+    assert len(empty) == 0 and len(empty.query('1', 5)) == 0
+
+if __name__ == '__main__':
+    run_tests()
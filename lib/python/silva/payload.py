@@ -0,0 +1,188 @@
+"""
+Side files of VCF payload
+
+The payload of a VCF record is everything after its ALT field (QUAL,
+FILTER, INFO, FORMAT and the genotype columns). For a large cohort it is
+most of the file, yet none of the pipeline needs it until the final
+output. PayloadWriter strips it off the records as they are read,
+replacing it with the record number (0-indexed, counting only records),
+and writes the payload of the records that are kept to a side file, to be
+rejoined with PayloadReader.
+
+A side file FILE has a header line (the names of the payload columns, from
+the #CHROM line of the VCF, if any) and then one payload per line. It is
+indexed by FILE.idx.npy: the record number and offset in FILE of each
+payload, sorted by record number. If there was nothing to strip (no
+payloads and no #CHROM line, e.g. just the first five VCF columns), no side
+file is written, and PayloadReader reads a missing one as empty.
+"""
+from __future__ import with_statement, division
+
+import os
+
+from collections import deque
+
+import numpy as np
+
+from silva.vcf import split_fields, join_fields
+
+# Name of the column that holds the record number in place of the payload
+PAYLOAD_FIELD = 'payload'
+VCF_FIELDS = 5
+
+
+def index_filename(filename):
+    return filename + '.idx.npy'
+
+
+class PayloadWriter(object):
+    """Strips the payload off VCF lines (see strip), writing that of the
+    records that are kept (see keep) to filename
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._ofp = open(filename, 'wb')
+        self._columns = None
+        # (record number, payload) of records stripped but not yet kept
+        # or passed over
+        self._pending = deque()
+        self._n_records = 0
+        self._stripped = False
+        self._records = []
+        self._offsets = []
+
+    def _write_header(self):
+        if self._columns is None:
+            self._columns = ''
+            print >>self._ofp, self._columns
+
+    def strip(self, lines):
+        """Yield the records in lines, each with its payload replaced by its
+        record number, held until it is kept or a later record is
+
+        Comment lines are dropped, the #CHROM line naming the payload columns.
+        """
+        for line in lines:
+            if line.startswith('#CHROM') and self._columns is None:
+                self._columns = split_fields(line, VCF_FIELDS)[1] or ''
+                print >>self._ofp, self._columns
+            if not line.strip() or line.startswith('#'): continue
+
+            fields, payload = split_fields(line, VCF_FIELDS)
+            record = self._n_records
+            self._n_records += 1
+            if payload is not None:
+                self._stripped = True
+                self._pending.append((record, payload))
+            yield join_fields(fields, str(record))
+
+    def keep(self, record):
+        """Write the payload of record (a number yielded by strip) to the
+        side file, dropping any held for earlier records
+
+        Records must be kept in the order they were stripped; keeping a
+        record more than once (e.g. once per alt allele) is fine.
+        """
+        pending = self._pending
+        while pending and pending[0][0] < record:
+            pending.popleft()
+        if pending and pending[0][0] == record:
+            self._write_header()
+            self._records.append(record)
+            self._offsets.append(self._ofp.tell())
+            print >>self._ofp, pending.popleft()[1]
+
+    def close(self):
+        self._pending.clear()
+        if self._columns is None and not self._stripped:
+            self._ofp.close()
+            os.remove(self._filename)
+            return
+
+        self._write_header()
+        self._ofp.close()
+        index = np.array([self._records, self._offsets], dtype=np.int64)
+        np.save(index_filename(self._filename), index.T)
+
+
+class PayloadReader(object):
+    """Looks up payloads in a side file written by PayloadWriter (none, if
+    it does not exist)
+    """
+    def __init__(self, filename):
+        self._ifp = None
+        # Payload column names, as a string of tab-delimited fields
+        self.columns = None
+        if os.path.exists(filename):
+            self._ifp = open(filename, 'rb')
+            self.columns = self._ifp.readline().rstrip('\n') or None
+            index = np.load(index_filename(filename))
+        else:
+            index = np.zeros((0, 2), dtype=np.int64)
+        self._records = index[:, 0]
+        self._offsets = index[:, 1]
+
+    def get(self, record):
+        """Return the payload of record (None if it has none)"""
+        record = int(record)
+        i = np.searchsorted(self._records, record)
+        if i == len(self._records) or self._records[i] != record:
+            return None
+        self._ifp.seek(self._offsets[i])
+        return self._ifp.readline().rstrip('\n')
+
+    def close(self):
+        if self._ifp:
+            self._ifp.close()
+
+
+def run_tests():
+    import shutil
+    from tempfile import mkdtemp
+    tmpdir = mkdtemp()
+    try:
+        # Payloads are stripped, and only those kept are written
+        filename = os.path.join(tmpdir, 'test.payload')
+        writer = PayloadWriter(filename)
+        vcf = ['##fileformat=VCFv4.1', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tINFO',
+               '1\t5\t.\tA\tG\t10\t.', '1\t6\t.\tA\tG', '1\t7\t.\tA\tG\t30\tX',
+               '1\t8\t.\tA\tG\t40\tY']
+        assert list(writer.strip(vcf)) == ['1\t5\t.\tA\tG\t0',
+                                           '1\t6\t.\tA\tG\t1',
+                                           '1\t7\t.\tA\tG\t2',
+                                           '1\t8\t.\tA\tG\t3']
+        for record in [1, 2, 2, 3]:
+            writer.keep(record)
+        writer.close()
+        reader = PayloadReader(filename)
+        assert reader.columns == 'QUAL\tINFO'
+        assert [reader.get(str(i)) for i in range(5)] == \
+            [None, None, '30\tX', '40\tY', None]
+        reader.close()
+
+        # Without a #CHROM line, or anything kept
+        writer = PayloadWriter(filename)
+        assert list(writer.strip(['1\t5\t.\tA\tG\t10'])) == ['1\t5\t.\tA\tG\t0']
+        writer.close()
+        reader = PayloadReader(filename)
+        assert reader.columns is None and reader.get(0) is None
+        reader.close()
+
+        # Nothing to strip (just the first five columns): no side file
+        os.remove(filename)
+        os.remove(index_filename(filename))
+        writer = PayloadWriter(filename)
+        assert list(writer.strip(['1\t5\t.\tA\tG', '1 6 . A G'])) == \
+            ['1\t5\t.\tA\tG\t0', '1\t6\t.\tA\tG\t1']
+        writer.keep(0)
+        writer.close()
+        assert not os.path.exists(filename)
+        assert not os.path.exists(index_filename(filename))
+        reader = PayloadReader(filename)
+        assert reader.columns is None and reader.get(0) is None
+        reader.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,105 @@
+"""
+Binary tables of variant sites
+
+A site table is a short text header naming the chromosomes and transcripts,
+followed by one fixed-size record (SITE_DTYPE) per site, in which the
+chromosome and transcript are indexes into those names:
+
+silva-sites<TAB>VERSION
+chroms<TAB>CHROM<TAB>...
+genes<TAB>GENE<TAB>...
+txs<TAB>TX<TAB>...
+RECORDS
+
+Records can be written as they are generated, and a table is read back as
+a memory-mapped numpy array.
+"""
+from __future__ import with_statement, division
+
+import numpy as np
+
+SITE_TABLE_VERSION = 1
+MAGIC = 'silva-sites'
+# pos is 1-indexed; ref and alt are on the + strand
+SITE_DTYPE = np.dtype([('chrom', '<u2'), ('pos', '<u4'), ('ref', 'S1'),
+                       ('alt', 'S1'), ('tx', '<u4')])
+
+
+def write_header(ofp, chroms, genes, txs):
+    """Write the header of a site table; genes and txs are parallel lists
+    of the gene and accession of each transcript
+    """
+    assert len(genes) == len(txs)
+    print >>ofp, '%s\t%d' % (MAGIC, SITE_TABLE_VERSION)
+    for name, values in [('chroms', chroms), ('genes', genes), ('txs', txs)]:
+        print >>ofp, '\t'.join([name] + list(values))
+
+
+def encode_sites(chrom, positions, refs, alts, tx):
+    """Return the records of sites, as a string
+
+    chrom, tx: indexes into the names in the header (tx may also be an
+        array, of the transcript of each site)
+    positions: genome positions (1-indexed)
+    refs, alts: strings of one base per site
+    """
+    sites = np.empty(len(positions), dtype=SITE_DTYPE)
+    sites['chrom'] = chrom
+    sites['pos'] = positions
+    sites['ref'] = np.frombuffer(refs, dtype='S1')
+    sites['alt'] = np.frombuffer(alts, dtype='S1')
+    sites['tx'] = tx
+    return sites.tostring()
+
+
+def read_site_table(filename):
+    """Return (chroms, genes, txs, sites), sites being a read-only array
+    of the records (SITE_DTYPE)
+    """
+    with open(filename, 'rb') as ifp:
+        magic, version = ifp.readline().rstrip('\n').split('\t')
+        assert magic == MAGIC and int(version) == SITE_TABLE_VERSION, \
+            "Not a site table (version %d): %s" % (SITE_TABLE_VERSION,
+                                                   filename)
+        names = {}
+        for name in ['chroms', 'genes', 'txs']:
+            tokens = ifp.readline().rstrip('\n').split('\t')
+            assert tokens[0] == name, "Invalid site table header: %s" % filename
+            names[name] = tokens[1:]
+        offset = ifp.tell()
+        ifp.seek(0, 2)
+        n_sites = (ifp.tell() - offset) // SITE_DTYPE.itemsize
+
+    if n_sites:
+        sites = np.memmap(filename, dtype=SITE_DTYPE, mode='r', offset=offset,
+                          shape=(n_sites,))
+    else:
+        sites = np.zeros(0, dtype=SITE_DTYPE)
+    return names['chroms'], names['genes'], names['txs'], sites
+
+
+def run_tests():
+    import os
+    from tempfile import mkstemp
+    fd, filename = mkstemp()
+    os.close(fd)
+    try:
+        with open(filename, 'wb') as ofp:
+            write_header(ofp, ['1', 'X'], ['A', 'B'], ['tx1', 'tx2'])
+            ofp.write(encode_sites(1, [5, 4294967295], 'AC', 'GT', 1))
+            ofp.write(encode_sites(0, [7], 'G', 'A', 0))
+        chroms, genes, txs, sites = read_site_table(filename)
+        assert (chroms, genes, txs) == (['1', 'X'], ['A', 'B'], ['tx1', 'tx2'])
+        assert sites.tolist() == [(1, 5, 'A', 'G', 1),
+                                  (1, 4294967295, 'C', 'T', 1),
+                                  (0, 7, 'G', 'A', 0)]
+
+        # A table of no sites
+        with open(filename, 'wb') as ofp:
+            write_header(ofp, [], [], [])
+        assert len(read_site_table(filename)[3]) == 0
+    finally:
+        os.remove(filename)
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,95 @@
+"""
+Lazy parsing of tab-delimited variant lines (VCF, and the files derived
+from it by the pipeline)
+
+Only the leading fields that are needed are split off a line. The rest of
+it (e.g. the INFO, FORMAT and genotype columns of a multi-sample VCF) is
+kept as a single string, to be passed through untouched. Genotypes are
+parsed a matrix at a time, with carriers.
+"""
+from __future__ import with_statement, division
+
+import numpy as np
+
+
+def split_fields(line, n):
+    """Return the first n fields of line (fewer if it has fewer), and the
+    rest of the line after them (None if there is nothing after them)
+
+    Fields are tab-delimited; lines without enough tabs are split on any
+    whitespace instead.
+    """
+    line = line.rstrip('\r\n')
+    tokens = line.split('\t', n)
+    if len(tokens) < n and ' ' in line:
+        tokens = line.split(None, n)
+    if len(tokens) > n:
+        return tokens[:n], tokens[n]
+    return tokens, None
+
+
+def join_fields(fields, rest=None):
+    """Return a line of fields, followed by rest if it is not None"""
+    line = '\t'.join(fields)
+    if rest is not None:
+        line += '\t' + rest
+    return line
+
+
+def iter_records(lines, n):
+    """Yield (fields, rest) of each line (see split_fields), skipping blank
+    and comment lines
+    """
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        yield split_fields(line, n)
+
+
+def carriers(formats, samples, allele='1'):
+    """Return a boolean matrix of whether each sample carries allele
+
+    formats: the FORMAT field of each record
+    samples: 2-d array of the sample fields (row per record, column per
+      sample), e.g. 0/1:35
+
+    Records without a genotype (GT, which must be the first field) are
+    carried by no one.
+    """
+    samples = np.asarray(samples, dtype=str)
+    if samples.size == 0:
+        return np.zeros(samples.shape, dtype=bool)
+    has_gt = np.char.partition(np.asarray(formats, dtype=str), ':')[:, 0] == 'GT'
+    genotypes = np.char.partition(samples, ':')[..., 0]
+    genotypes = np.char.replace(genotypes, '|', '/')
+    # Match whole alleles: /0/1/ has /1/, but /0/11/ does not
+    genotypes = np.char.add(np.char.add('/', genotypes), '/')
+    found = np.char.find(genotypes, '/%s/' % allele) >= 0
+    return found & has_gt[:, np.newaxis]
+
+
+def run_tests():
+    # Only the leading fields are split; the rest passes through untouched
+    line = '1\t100\trs1\tA\tG\t50\tPASS\t.\tGT\t0/1\t1/1\n'
+    fields, rest = split_fields(line, 5)
+    assert fields == ['1', '100', 'rs1', 'A', 'G']
+    assert rest == '50\tPASS\t.\tGT\t0/1\t1/1'
+    assert join_fields(fields, rest) == line.rstrip('\n')
+    assert split_fields('1\t100\r\n', 5) == (['1', '100'], None)
+    assert join_fields(['1', '100']) == '1\t100'
+    # Lines without tabs are split on whitespace
+    assert split_fields('1 100 rs1 A G', 5) == (['1', '100', 'rs1', 'A', 'G'],
+                                                 None)
+    assert list(iter_records(['##x', '#CHROM', '', line], 2)) == \
+        [(['1', '100'], 'rs1\tA\tG\t50\tPASS\t.\tGT\t0/1\t1/1')]
+
+    # Whole alleles of GT, which must come first, whatever the phasing
+    assert carriers(['GT:DP', 'DP', 'GT'],
+                    [['0/1:35', '1|1:4', './.:0'], ['0/1', '1', '1'],
+                     ['11/0', '0|1', '0']]).tolist() == \
+        [[True, True, False], [False, False, False], [False, True, False]]
+    assert carriers(['GT'], [['0/2']], allele='2').tolist() == [[True]]
+    assert carriers([], np.zeros((0, 3), dtype=str)).shape == (0, 3)
+
+if __name__ == '__main__':
+    run_tests()
@@ -7,16 +7,26 @@ No warranty is provided, express or implied
 from array import array
 from bisect import bisect_right
 from errno import ENOENT, EACCES
-from os import R_OK, access
+from os import R_OK, access, getpid
 try:
     from os import strerror
 except ImportError:
     strerror = lambda x: 'strerror not supported'
-from os.path import exists, getsize
+from os.path import exists, getsize, getmtime
+from collections import OrderedDict
 from itertools import izip
+from string import maketrans
+import cPickle
 import logging
+import mmap
+import re
 import textwrap
+import threading
 import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def true_long_type():
@@ -104,11 +114,94 @@ def create_twobyte_table():
 
 BYTE_TABLE = create_byte_table()
 TWOBYTE_TABLE = create_twobyte_table()
+# BYTE_TABLE as a list of 4-character strings, indexed by byte value
+BYTE_STRINGS = [''.join(BYTE_TABLE[x]) for x in xrange(2**8)]
+
+
+# Packed regions shorter than this many bytes are decoded in pure python,
+# since the numpy call overhead outweighs the gain for a handful of codons
+NUMPY_MIN_BYTES = 64
+_NUMPY_TABLES = {}
+
+
+def numpy_byte_table(twobyte=False):
+    """
+    returns the numpy decoding table: a 256x4 uint8 array of base
+    characters for each byte value, or a 65536x8 array for each big-endian
+    pair of bytes if twobyte is True (built on first use, as it is 512 kB)
+    """
+    if numpy is None:
+        raise ImportError('numpy is required for the vectorized decoder')
+    key = 'twobyte' if twobyte else 'byte'
+    table = _NUMPY_TABLES.get(key)
+    if table is None:
+        if twobyte:
+            strings = [BYTE_STRINGS[c] + BYTE_STRINGS[f]
+                       for c, f in (split16(x) for x in xrange(2**16))]
+            table = numpy.frombuffer(''.join(strings), dtype=numpy.uint8)
+            table = table.reshape(2**16, 8)
+        else:
+            table = numpy.frombuffer(''.join(BYTE_STRINGS), dtype=numpy.uint8)
+            table = table.reshape(2**8, 4)
+        _NUMPY_TABLES[key] = table
+    return table
+
+
+def bytes_to_ndarray(packed, first_base_offset, array_size, twobyte=False):
+    """
+    vectorized counterpart of bytes_to_char_array
+    takes in a string or buffer of packed dna (4 bases per byte) and
+    returns a uint8 numpy array of base characters, decoded with a single
+    lookup into numpy_byte_table (use .tostring() to get a string)
+    with twobyte=True, bytes are decoded in pairs through the 16-bit table
+    """
+    if array_size < 0:
+        raise ValueError('array_size must be at least 0')
+    if not first_base_offset in range(4):
+        raise ValueError('first_base_offset must be in range(4)')
+    bytes_ = numpy.frombuffer(packed, dtype=numpy.uint8)
+    if array_size > len(bytes_) * 4 - first_base_offset:
+        raise ValueError('array_size exceeds maximum possible for input')
+    if twobyte:
+        if len(bytes_) % 2:
+            bytes_ = numpy.append(bytes_, numpy.uint8(0))
+        dna = numpy_byte_table(True)[bytes_.view('>u2')]
+    else:
+        dna = numpy_byte_table()[bytes_]
+    return dna.ravel()[first_base_offset:first_base_offset + array_size]
+
+
+def bytes_to_char_array(packed, first_base_offset, array_size):
+    """
+    takes in a string or buffer of packed dna (4 bases per byte) and
+    converts it to bases in a char array
+    first_base_offset is the offset of the first desired base within the
+    first byte (pythonic, in range(4)), and array_size the number of
+    bases desired
+    If numpy is available, regions of NUMPY_MIN_BYTES or more are decoded
+    with bytes_to_ndarray
+
+    Unlike longs_to_char_array, the packed dna is treated as the byte
+    stream it is in the file, so no byteswapping is ever needed
+    """
+    if array_size == 0:
+        return array('c')
+    elif array_size < 0:
+        raise ValueError('array_size must be at least 0')
+    if not first_base_offset in range(4):
+        raise ValueError('first_base_offset must be in range(4)')
+    if numpy is not None and len(packed) >= NUMPY_MIN_BYTES:
+        dna = bytes_to_ndarray(packed, first_base_offset, array_size)
+        return array('c', dna.tostring())
+    bytes_ = bytearray(packed)
+    if array_size > len(bytes_) * 4 - first_base_offset:
+        raise ValueError('array_size exceeds maximum possible for input')
+    dna = array('c', ''.join([BYTE_STRINGS[byte] for byte in bytes_]))
+    return dna[first_base_offset:first_base_offset + array_size]
 
 
 def longs_to_char_array(longs, first_base_offset, last_base_offset, array_size,
-                        more_bytes=None):
-    if more_bytes is not None: print array('B', more_bytes)
+                        more_bytes=None, byteswapped=False):
     """
     takes in an array of longs (4 bytes) and converts them to bases in
     a char array
@@ -117,7 +210,9 @@ def longs_to_char_array(longs, first_base_offset, last_base_offset, array_size,
     and the desired array_size
     If you have less than a long worth of bases at the end, you can provide
     them as a string with more_bytes=
-    
+    If the longs were byteswapped after being read from a byteswapped file,
+    pass byteswapped=True so they are decoded in file byte order
+
     NOTE: last_base_offset is inside more_bytes not the last long, if more_bytes
           is not None
     returns the correct subset of the array based on provided offsets
@@ -134,55 +229,120 @@ def longs_to_char_array(longs, first_base_offset, last_base_offset, array_size,
 
     longs_len = len(longs)
     if more_bytes is None:
-        shorts_length = 0
-    else:
-        shorts_length = len(more_bytes)
-    if array_size > longs_len * 16 + 4 * shorts_length:
+        more_bytes = ''
+    if array_size > longs_len * 16 + 4 * len(more_bytes):
         raise ValueError('array_size exceeds maximum possible for input')
 
-    dna = array('c', 'N' * (longs_len * 16 + 4 * shorts_length))
-    # translate from 32-bit blocks to bytes
-    # this method ensures correct endianess (byteswap as neeed)
-    bytes_ = array('B')
-    bytes_.fromstring(longs.tostring())
-    # first block
-    first_block = ''.join([''.join(BYTE_TABLE[bytes_[x]]) for x in range(4)])
-    i = 16 - first_base_offset
-    if array_size < i:
-        i = array_size
-    dna[0:i] = array('c', first_block[first_base_offset:first_base_offset + i])
-    if longs_len > 1:
-        # middle blocks (implicitly skipped if they don't exist)
-        for byte in bytes_[4:-4]:
-            dna[i:i + 4] = array('c', BYTE_TABLE[byte])
-            i += 4
-        # last block
-        last_block = array('c', ''.join([''.join(BYTE_TABLE[bytes_[x]])
-                                         for x in range(-4, 0)]))
-        if more_bytes is None:
-            dna[i:i + last_base_offset] = last_block[0:last_base_offset]
-        else: # if there are more bytes, we need the whole last block
-            dna[i:i + 16] = last_block[0:16]
-        i += 16
-    if more_bytes is not None:
-        bytes_ = array('B')
-        bytes_.fromstring(more_bytes)
-        j = i
-        for byte in bytes_:
-            j = i + 4
-            if j > array_size:
-                dnabytes = array('c', BYTE_TABLE[byte])[0:(array_size - i)]
-                dna[i:array_size] = dnabytes
-                break
-            dna[i:i + last_base_offset] = array('c', BYTE_TABLE[byte])
-            i += 4
-    return dna[0:array_size]
+    if byteswapped:
+        longs = array(longs.typecode, longs)
+        longs.byteswap()
+    # the longs are just the packed bytes, four at a time
+    packed = longs.tostring() + more_bytes
+    first_byte = first_base_offset / 4
+    return bytes_to_char_array(buffer(packed, first_byte),
+                               first_base_offset % 4, array_size)
+
+
+COMPLEMENT_TABLE = maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def reverse_complement(seq):
+    """returns the reverse complement of a dna string"""
+    return seq.translate(COMPLEMENT_TABLE)[::-1]
+
+
+class BlockCache(object):
+    """
+    least-recently-used cache of decoded sequence blocks, shared by the
+    sequences of a TwoBitFile (see cache_bytes=)
+
+    Sequences are decoded in aligned blocks of block_size bases, and up to
+    max_bytes of decoded blocks are kept. hits and misses count lookups.
+    """
+    def __init__(self, max_bytes, block_size=65536):
+        if block_size <= 0:
+            raise ValueError('block_size must be positive')
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.hits = 0
+        self.misses = 0
+        self._n_bytes = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def n_bytes(self):
+        """returns the total size of the cached blocks"""
+        return self._n_bytes
+
+    def get(self, key):
+        """returns the cached block for key, or None"""
+        with self._lock:
+            block = self._blocks.pop(key, None)
+            if block is None:
+                self.misses += 1
+            else:
+                # re-insert as most recently used
+                self._blocks[key] = block
+                self.hits += 1
+            return block
+
+    def put(self, key, block):
+        """caches block, evicting least recently used blocks as needed"""
+        if len(block) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self._n_bytes -= len(old)
+            self._blocks[key] = block
+            self._n_bytes += len(block)
+            while self._n_bytes > self.max_bytes:
+                old_key, old = self._blocks.popitem(last=False)
+                self._n_bytes -= len(old)
+
+    def clear(self):
+        """empties the cache (hits and misses are kept)"""
+        with self._lock:
+            self._blocks.clear()
+            self._n_bytes = 0
+
+
+# Bump whenever the layout of the sidecar index written by save_index changes
+SIDECAR_INDEX_VERSION = 1
+
+
+def normalize_slice(min_, max_, dna_size):
+    """
+    returns the (min_, max_) range a slice refers to in a sequence of
+    length dna_size, resolving negative coordinates and truncating max_ at
+    the end of the sequence, or None if the range is empty
+    """
+    # handle negative coordinates
+    if max_ is not None and max_ < 0:
+        if max_ < -dna_size:
+            raise IndexError('index out of range')
+        max_ = dna_size + 1 + max_
+    if min_ < 0:
+        if max_ < -dna_size:
+            raise IndexError('index out of range')
+        min_ = dna_size + 1 + min_
+    # make sure there's a proper range
+    if max_ is not None and min_ > max_:
+        return None
+    if max_ == 0 or max_ == min_:
+        return None
+    if max_ is None or max_ > dna_size:
+        max_ = dna_size
+    return min_, max_
 
 
 class TwoBitFile(dict):
     """
 python-level reader for .2bit files (i.e., from UCSC genome browser)
-(note: no writing support)
+(for writing, see write_twobit)
 
 TwoBitFile inherits from dict
 You may access sequences by name, e.g.
@@ -199,10 +359,47 @@ tttgcatgttaagtttttttcc'
 
 Fair warning: dumping the entire chromosome requires a lot of memory
 
+With use_mmap=True, the file is memory-mapped once and sequences are
+decoded directly out of the mapped buffer, rather than with a seek and
+read per slice. The mapping is read-only, so the pages are shared through
+the OS page cache by every process reading the same file.
+>>> genome = TwoBitFile('hg18.2bit', use_mmap=True)
+
+Sequence record headers (sizes and N-block tables) are only read when a
+sequence is first used, so opening a genome costs little more than reading
+the list of names. With index_filename=, the headers of every sequence are
+cached in that sidecar file, which is written if it is missing or out of
+date with the .2bit file, and read instead of the file's headers otherwise.
+>>> genome = TwoBitFile('hg18.2bit', index_filename='hg18.2bit.idx')
+
+By default, all sequences share one file handle, so a TwoBitFile must not
+be read from several threads at once, or by several processes after a
+fork. With threadsafe=True, every thread (and every forked process) reads
+through its own handle instead, opened on first use; the header and index
+already parsed are shared. Memory-mapped reads need no handle at all, and
+are always safe to share.
+>>> genome = TwoBitFile('hg18.2bit', threadsafe=True)
+
+With cache_bytes=, sequences are decoded in blocks of cache_block_size
+bases, and up to cache_bytes of decoded blocks are kept in an LRU cache
+(genome.block_cache), so nearby slices (e.g. isoforms of a gene, or
+variants in the same exon) do not read and decode the same region again.
+>>> genome = TwoBitFile('hg18.2bit', cache_bytes=64 * 2**20)
+>>> genome.block_cache.hits, genome.block_cache.misses
+
+A subset .2bit file (see twobitreader.subset) holds only some regions of a
+genome, with a remapping table beside it (foo + REMAP_SUFFIX, or
+remap_filename=). If the table exists, the remapped sequences are returned
+as SubsetTwoBitSequence objects, which are sliced with the original genomic
+coordinates and have the original lengths; bases outside the stored regions
+read as N.
+
 See TwoBitSequence for more info
     """
 
-    def __init__(self, foo):
+    def __init__(self, foo, use_mmap=False, index_filename=None,
+                 threadsafe=False, cache_bytes=0, cache_block_size=65536,
+                 remap_filename=None):
         super(TwoBitFile, self).__init__()
         if not exists(foo):
             raise IOError(ENOENT, strerror(ENOENT), foo)
@@ -211,14 +408,126 @@ See TwoBitSequence for more info
         self._filename = foo
         self._file_size = getsize(foo)
         self._file_handle = open(foo, 'rb')
-        self._load_header()
-        self._load_index()
+        if use_mmap:
+            self._mmap = mmap.mmap(self._file_handle.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        else:
+            self._mmap = None
+        self._threadsafe = threadsafe
+        self._local = threading.local()
+        if cache_bytes > 0:
+            self.block_cache = BlockCache(cache_bytes, cache_block_size)
+        else:
+            self.block_cache = None
+        headers = None
+        if index_filename is not None:
+            headers = self._load_sidecar_index(index_filename)
+        if headers is None:
+            self._load_header()
+            self._load_index()
+            headers = {}
+        # records are the sequences as stored in the file
+        self._records = {}
         for name, offset in self._offset_dict.iteritems():
-            self[name] = TwoBitSequence(self._file_handle, offset,
-                                        self._file_size,
-                                        self._byteswapped)
+            self._records[name] = TwoBitSequence(self._file_handle, offset,
+                                                 self._file_size,
+                                                 self._byteswapped,
+                                                 mapped=self._mmap,
+                                                 header=headers.get(name),
+                                                 read_at=self.read_at,
+                                                 block_cache=self.block_cache)
+        self.update(self._records)
+        if remap_filename is None and exists(foo + REMAP_SUFFIX):
+            remap_filename = foo + REMAP_SUFFIX
+        self._remap = {}
+        if remap_filename is not None:
+            self._remap = read_remap_table(remap_filename)
+            for name, (size, starts, ends, offsets) in self._remap.iteritems():
+                self[name] = SubsetTwoBitSequence(self._records[name], size,
+                                                  starts, ends, offsets)
+        if index_filename is not None and not headers:
+            self.save_index(index_filename)
         return
 
+    def _get_file_handle(self):
+        """
+        returns the file handle for the current thread and process
+        (the shared one, unless threadsafe)
+        """
+        if not self._threadsafe:
+            return self._file_handle
+        local = self._local
+        pid = getpid()
+        if getattr(local, 'pid', None) != pid:
+            # a new thread, or a process forked with this TwoBitFile
+            local.file_handle = open(self._filename, 'rb')
+            local.pid = pid
+        return local.file_handle
+
+    def read_at(self, offset, size):
+        """
+        returns size bytes of the file starting at offset, as a string
+        reads are positional: they never depend on or disturb the position
+        of a handle shared with other threads (see threadsafe)
+        """
+        if self._mmap is not None:
+            return self._mmap[offset:offset + size]
+        file_handle = self._get_file_handle()
+        file_handle.seek(offset)
+        return file_handle.read(size)
+
+    def _load_sidecar_index(self, index_filename):
+        """
+        reads the index and record headers from a file written by save_index
+        returns a dict: name -> header, or None if the file is missing or
+        does not match this .2bit file
+        """
+        if not exists(index_filename):
+            return None
+        try:
+            with open(index_filename, 'rb') as ifp:
+                index = cPickle.load(ifp)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        if not isinstance(index, dict) or \
+                index.get('version') != SIDECAR_INDEX_VERSION or \
+                index.get('file_size') != self._file_size or \
+                index.get('mtime') != getmtime(self._filename):
+            return None
+        self._byteswapped = index['byteswapped']
+        self._sequence_count = len(index['sequence_offsets'])
+        self._sequence_offsets = index['sequence_offsets']
+        self._offset_dict = dict(self._sequence_offsets)
+        headers = {}
+        for name, (dna_size, n_block_starts, n_block_sizes, mask_offset,
+                   offset) in index['headers'].iteritems():
+            starts = array(LONG)
+            starts.fromstring(n_block_starts)
+            sizes = array(LONG)
+            sizes.fromstring(n_block_sizes)
+            headers[name] = (dna_size, starts, sizes, mask_offset, offset)
+        return headers
+
+    def save_index(self, index_filename):
+        """
+        writes the index and the record headers of every sequence to
+        index_filename, to be read back with TwoBitFile(index_filename=)
+        """
+        headers = {}
+        for name, sequence in self._records.iteritems():
+            (dna_size, n_block_starts, n_block_sizes, mask_offset,
+             offset) = sequence.header()
+            headers[name] = (dna_size, n_block_starts.tostring(),
+                             n_block_sizes.tostring(), mask_offset, offset)
+        index = {'version': SIDECAR_INDEX_VERSION,
+                 'file_size': self._file_size,
+                 'mtime': getmtime(self._filename),
+                 'byteswapped': self._byteswapped,
+                 'sequence_offsets': self._sequence_offsets,
+                 'headers': headers}
+        with open(index_filename, 'wb') as ofp:
+            cPickle.dump(index, ofp, cPickle.HIGHEST_PROTOCOL)
+
     def _load_header(self):
         file_handle = self._file_handle
         header = array(LONG)
@@ -269,17 +578,63 @@ See TwoBitSequence for more info
     def sequence_sizes(self):
         """returns a dictionary with the sizes of each sequence"""
         d = {}
-        file_handle = self._file_handle
         byteswapped = self._byteswapped
         for name, offset in self._offset_dict.iteritems():
-            file_handle.seek(offset)
             dna_size = array(LONG)
-            dna_size.fromfile(file_handle, 1)
+            dna_size.fromstring(self.read_at(offset, 4))
             if byteswapped:
                 dna_size.byteswap()
             d[name] = dna_size[0]
+        # subset files report the sizes of the original sequences
+        for name, (size, starts, ends, offsets) in self._remap.iteritems():
+            d[name] = size
         return d
 
+    def get_regions(self, regions):
+        """
+        get_regions fetches many regions at once
+        regions is an iterable of (chrom, start, end) or
+        (chrom, start, end, strand) tuples, 0-based and end-open
+        returns a list with the sequence (string) of each region, in order,
+        reverse-complemented if strand is '-'
+
+        Regions are sorted and merged per chrom, so that overlapping and
+        adjacent regions are read and decoded once, as a single span.
+        As with slicing, regions are truncated at the end of the sequence.
+        """
+        regions = list(regions)
+        by_chrom = {}
+        for i, region in enumerate(regions):
+            by_chrom.setdefault(region[0], []).append(i)
+        result = [None] * len(regions)
+        for chrom, indices in by_chrom.iteritems():
+            sequence = self[chrom]
+            indices.sort(key=lambda i: regions[i][1])
+            span_start = span_end = None
+            members = []
+            for i in indices + [None]:
+                if i is not None:
+                    start, end = regions[i][1:3]
+                    if span_end is not None and start <= span_end:
+                        members.append(i)
+                        span_end = max(span_end, end)
+                        continue
+                if members:
+                    span = sequence.get_slice(span_start, span_end)
+                    if not isinstance(span, str):
+                        span = span.tostring()
+                    for j in members:
+                        region = regions[j]
+                        seq = span[region[1] - span_start:
+                                   region[2] - span_start]
+                        if len(region) > 3 and region[3] == '-':
+                            seq = reverse_complement(seq)
+                        result[j] = seq
+                if i is not None:
+                    span_start, span_end = start, end
+                    members = [i]
+        return result
+
 
 class TwoBitSequence(object):
     """
@@ -308,51 +663,106 @@ but if you want to string-ize your TwoBitFile, here's a recipe:
 x = TwoBitFile('my.2bit')
 d = x.dict()
 for k,v in d.iteritems(): d[k] = str(v)
+
+If mapped is provided (a memory map of the whole file), the packed dna is
+decoded straight from it instead of being read through file_handle.
+If read_at is provided (see TwoBitFile.read_at), all reads go through it
+instead of through file_handle.
+If block_cache is provided (a BlockCache, possibly shared with other
+sequences), slices are assembled from cached, decoded blocks.
     """
-    def __init__(self, file_handle, offset, file_size, byteswapped=False):
+    def __init__(self, file_handle, offset, file_size, byteswapped=False,
+                 mapped=None, header=None, read_at=None, block_cache=None):
         self._file_size = file_size
+        self._block_cache = block_cache
         self._file_handle = file_handle
+        self._mapped = mapped
+        if read_at is None:
+            read_at = self._read_from_handle
+        self._read_at = read_at
         self._original_offset = offset
         self._byteswapped = byteswapped
-        file_handle.seek(offset)
-        header = array(LONG)
-        header.fromfile(file_handle, 2)
-        if byteswapped:
-            header.byteswap()
-        dna_size, n_block_count = header
+        self._mask_block_starts = None
+        self._mask_block_sizes = None
+        # the record header (sizes and block tables) is only read when the
+        # sequence is first used, unless it is provided (see header())
+        self._header_loaded = False
+        if header is not None:
+            self._set_header(*header)
+
+    def _set_header(self, dna_size, n_block_starts, n_block_sizes,
+                    mask_offset, offset):
         self._dna_size = dna_size  # number of characters, 2 bits each
         self._n_bytes = (dna_size + 3) / 4  # number of bytes
         # number of 32-bit fragments
         self._packed_dna_size = (dna_size + 15) / 16
-        n_block_starts = array(LONG)
-        n_block_sizes = array(LONG)
-        n_block_starts.fromfile(file_handle, n_block_count)
-        if byteswapped:
-            n_block_starts.byteswap()
-        n_block_sizes.fromfile(file_handle, n_block_count)
-        if byteswapped:
-            n_block_sizes.byteswap()
         self._n_block_starts = n_block_starts
         self._n_block_sizes = n_block_sizes
-        mask_rawc = array(LONG)
-        mask_rawc.fromfile(file_handle, 1)
-        if byteswapped:
-            mask_rawc.byteswap()
-        mask_block_count = mask_rawc[0]
-        mask_block_starts = array(LONG)
-        mask_block_starts.fromfile(file_handle, mask_block_count)
-        if byteswapped:
-            mask_block_starts.byteswap()
-        mask_block_sizes = array(LONG)
-        mask_block_sizes.fromfile(file_handle, mask_block_count)
-        if byteswapped:
-            mask_block_sizes.byteswap()
-        self._mask_block_starts = mask_block_starts
-        self._mask_block_sizes = mask_block_sizes
-        file_handle.read(4)
-        self._offset = file_handle.tell()
+        # N blocks never overlap, so their ends are sorted as well, and the
+        # first block overlapping a region can be found by bisection
+        self._n_block_ends = array(LONG, [start + size for start, size in
+                                          izip(n_block_starts, n_block_sizes)])
+        self._mask_offset = mask_offset  # file offset of maskBlockCount
+        self._offset = offset  # file offset of packedDna
+        self._header_loaded = True
+
+    def _read_from_handle(self, offset, size):
+        file_handle = self._file_handle
+        file_handle.seek(offset)
+        return file_handle.read(size)
+
+    def _read_longs(self, offset, count):
+        """returns an array of count longs read at offset, byteswapped"""
+        longs = array(LONG)
+        longs.fromstring(self._read_at(offset, 4 * count))
+        if len(longs) != count:
+            raise EOFError('2-bit file ended within a sequence record')
+        if self._byteswapped:
+            longs.byteswap()
+        return longs
+
+    def _load_header(self):
+        offset = self._original_offset
+        dna_size, n_block_count = self._read_longs(offset, 2)
+        offset += 8
+        n_blocks = self._read_longs(offset, 2 * n_block_count)
+        n_block_starts = n_blocks[:n_block_count]
+        n_block_sizes = n_blocks[n_block_count:]
+        mask_offset = offset + 8 * n_block_count
+        mask_block_count = self._read_longs(mask_offset, 1)[0]
+        # skip the mask blocks and the reserved field, without reading them
+        offset = mask_offset + 4 + 8 * mask_block_count + 4
+        self._set_header(dna_size, n_block_starts, n_block_sizes,
+                         mask_offset, offset)
+
+    def header(self):
+        """
+        returns the parsed record header, loading it if needed, in a form
+        that can be passed back to the constructor as header=
+        """
+        if not self._header_loaded:
+            self._load_header()
+        return (self._dna_size, self._n_block_starts, self._n_block_sizes,
+                self._mask_offset, self._offset)
+
+    def get_mask_blocks(self):
+        """
+        returns (starts, sizes) of the masked (lower case) blocks
+        these are not needed for slicing, so they are read on first use
+        """
+        if self._mask_block_starts is None:
+            if not self._header_loaded:
+                self._load_header()
+            mask_block_count = self._read_longs(self._mask_offset, 1)[0]
+            mask_blocks = self._read_longs(self._mask_offset + 4,
+                                           2 * mask_block_count)
+            self._mask_block_starts = mask_blocks[:mask_block_count]
+            self._mask_block_sizes = mask_blocks[mask_block_count:]
+        return self._mask_block_starts, self._mask_block_sizes
 
     def __len__(self):
+        if not self._header_loaded:
+            self._load_header()
         return self._dna_size
 
     def __getslice__(self, min_, max_=None):
@@ -362,98 +772,27 @@ for k,v in d.iteritems(): d[k] = str(v)
         """
         get_slice returns only a sub-sequence
         """
-        # handle negative coordinates
-        dna_size = self._dna_size
-        if max_ is not None and max_ < 0:
-            if max_ < -dna_size:
-                raise IndexError('index out of range')
-            max_ = dna_size + 1 + max_
-        if min_ < 0:
-            if max_ < -dna_size:
-                raise IndexError('index out of range')
-            min_ = dna_size + 1 + min_
-        # make sure there's a proper range
-        if max_ is not None and min_ > max_:
-            return ''
-        if max_ == 0 or max_ == min_:
+        if not self._header_loaded:
+            self._load_header()
+        region = normalize_slice(min_, max_, self._dna_size)
+        if region is None:
             return ''
-        # load all the data
-        if max_ is None or max_ > dna_size:
-            max_ = dna_size
-        file_handle = self._file_handle
-        byteswapped = self._byteswapped
-        n_block_starts = self._n_block_starts
-        n_block_sizes = self._n_block_sizes
-        mask_block_starts = self._mask_block_starts
-        mask_block_sizes = self._mask_block_sizes
-        offset = self._offset
-        packed_dna_size = self._packed_dna_size
-        #n_bytes = self._n_bytes
-
-        # region_size is how many bases the region is
-        if max_ is None:
-            region_size = dna_size - min_
-        else:
-            region_size = max_ - min_
+        min_, max_ = region
 
-        # start_block, end_block are the first/last 32-bit blocks we need
-        # blocks start at 0
-        start_block = min_ / 16
-        # jump directly to desired file location
-        local_offset = offset + (start_block * 4)
-        end_block = (max_ - 1 + 16) / 16
-        # don't read past seq end
-
-        file_handle.seek(local_offset)
-
-        # note we won't actually read the last base
-        # this is a python slice first_base_offset:16*blocks+last_base_offset
-        first_base_offset = min_ % 16
-        last_base_offset = max_ % 16
-        if last_base_offset == 0:
-            last_base_offset = 16
-        # +1 we still need to read end_block maybe
-        blocks_to_read = end_block - start_block
-        if (blocks_to_read + start_block) > packed_dna_size:
-            blocks_to_read = packed_dna_size - start_block
-
-        fourbyte_dna = array(LONG)
-        # remainder_seq = None
-        if (blocks_to_read * 4 + local_offset) > self._file_size:
-            fourbyte_dna.fromfile(file_handle, blocks_to_read - 1)
-            morebytes = file_handle.read()  # read the remaining characters
-#            if byteswapped:
-#                morebytes = ''.join(reversed(morebytes))
+        if self._block_cache is not None:
+            str_as_array = self._get_cached_slice(min_, max_)
         else:
-            fourbyte_dna.fromfile(file_handle, blocks_to_read)
-            morebytes = None
-        if byteswapped:
-            fourbyte_dna.byteswap()
-        str_as_array = longs_to_char_array(fourbyte_dna, first_base_offset,
-                                           last_base_offset, region_size,
-                                           more_bytes=morebytes)
-        for start, size in izip(n_block_starts, n_block_sizes):
-            end = start + size
-            if end <= min_:
-                continue
-            if start > max_:
-                break
-            if start < min_:
-                start = min_
-            if end > max_:
-                end = max_
-            start -= min_
-            end -= min_
-            # this should actually be decoded, 00=N, 01=n
-            str_as_array[start:end] = array('c', 'N'*(end-start))
-        lower = str.lower
-        first_masked_region = max(0,
-                                  bisect_right(mask_block_starts, min_) - 1)
-        last_masked_region = min(len(mask_block_starts),
-                                 1 + bisect_right(mask_block_starts, max_,
-                                                  lo=first_masked_region))
+            str_as_array = self._decode(min_, max_)
 
         # Region below commented out by OJB as unnecessary for SilVA:
+        # (the mask blocks are now only read on demand, with get_mask_blocks)
+        # lower = str.lower
+        # mask_block_starts, mask_block_sizes = self.get_mask_blocks()
+        # first_masked_region = max(0,
+        #                           bisect_right(mask_block_starts, min_) - 1)
+        # last_masked_region = min(len(mask_block_starts),
+        #                          1 + bisect_right(mask_block_starts, max_,
+        #                                           lo=first_masked_region))
         # for start, size in izip(mask_block_starts[first_masked_region:
         #                                           last_masked_region],
         #                         mask_block_sizes[first_masked_region:
@@ -479,6 +818,96 @@ for k,v in d.iteritems(): d[k] = str(v)
         # for SilVA performance reasons
         return str_as_array
 
+    def _decode(self, min_, max_):
+        """
+        reads and decodes [min_, max_) into a char array, with N blocks
+        applied (0 <= min_ < max_ <= len(self))
+        """
+        # region_size is how many bases the region is
+        region_size = max_ - min_
+
+        # first_byte, end_byte are the packed bytes we need (4 bases each)
+        # they are always inside this sequence's packed dna, so there is no
+        # special case at the end of the file
+        first_byte = min_ / 4
+        end_byte = (max_ + 3) / 4
+        first_base_offset = min_ % 4
+        # jump directly to desired file location
+        local_offset = self._offset + first_byte
+        if self._mapped is not None:
+            packed = buffer(self._mapped, local_offset, end_byte - first_byte)
+        else:
+            packed = self._read_at(local_offset, end_byte - first_byte)
+        str_as_array = bytes_to_char_array(packed, first_base_offset,
+                                           region_size)
+        for start, end in self._iter_n_blocks(min_, max_):
+            # this should actually be decoded, 00=N, 01=n
+            str_as_array[start:end] = array('c', 'N'*(end-start))
+        return str_as_array
+
+    def _get_cached_slice(self, min_, max_):
+        """
+        assembles [min_, max_) from decoded fixed-size blocks, using and
+        filling the block cache
+        """
+        cache = self._block_cache
+        block_size = cache.block_size
+        key_base = self._original_offset
+        dna_size = self._dna_size
+        blocks = []
+        first_block = min_ / block_size
+        for block in xrange(first_block, (max_ - 1) / block_size + 1):
+            key = (key_base, block)
+            decoded = cache.get(key)
+            if decoded is None:
+                start = block * block_size
+                decoded = self._decode(start,
+                                       min(start + block_size,
+                                           dna_size)).tostring()
+                cache.put(key, decoded)
+            blocks.append(decoded)
+        offset = min_ - first_block * block_size
+        return array('c', ''.join(blocks)[offset:offset + max_ - min_])
+
+    def _iter_n_blocks(self, min_, max_):
+        """
+        yields (start, end) of each N block overlapping [min_, max_),
+        clipped to the region and relative to min_
+        only the overlapping blocks are visited
+        """
+        n_block_starts = self._n_block_starts
+        n_block_ends = self._n_block_ends
+        for i in xrange(bisect_right(n_block_ends, min_), len(n_block_ends)):
+            start = n_block_starts[i]
+            if start >= max_:
+                break
+            end = n_block_ends[i]
+            if start < min_:
+                start = min_
+            if end > max_:
+                end = max_
+            yield start - min_, end - min_
+
+    def get_n_mask(self, min_=0, max_=None):
+        """
+        get_n_mask returns an array('B') with one entry per base in
+        [min_, max_), 1 where the base is an N and 0 otherwise
+        (coordinates are 0-based, end-open, truncated to the sequence)
+        """
+        if not self._header_loaded:
+            self._load_header()
+        dna_size = self._dna_size
+        if min_ < 0:
+            min_ = 0
+        if max_ is None or max_ > dna_size:
+            max_ = dna_size
+        if max_ <= min_:
+            return array('B')
+        mask = array('B', [0]) * (max_ - min_)
+        for start, end in self._iter_n_blocks(min_, max_):
+            mask[start:end] = array('B', [1]) * (end - start)
+        return mask
+
     def __str__(self):
         """
         returns the entire chromosome
@@ -488,6 +917,210 @@ for k,v in d.iteritems(): d[k] = str(v)
         return self.__getslice__(0, None).tostring()
 
 
+class SubsetTwoBitSequence(object):
+    """
+A SubsetTwoBitSequence is a sequence of a subset .2bit file, addressed with
+the coordinates of the original sequence
+
+Only the regions [starts[i], ends[i]) of the original sequence are stored,
+one after another in record, with region i at offsets[i]. Slicing works
+as for TwoBitSequence, over the original length (size); bases outside the
+stored regions are returned as N.
+    """
+    def __init__(self, record, size, starts, ends, offsets):
+        self._record = record
+        self._dna_size = size
+        self._starts = starts
+        self._ends = ends
+        self._offsets = offsets
+
+    def __len__(self):
+        return self._dna_size
+
+    def __getslice__(self, min_, max_=None):
+        return self.get_slice(min_, max_)
+
+    def _iter_pieces(self, min_, max_):
+        """
+        yields (start, end, record_offset) of each stored region
+        overlapping [min_, max_), clipped to it (original coordinates)
+        """
+        starts = self._starts
+        ends = self._ends
+        offsets = self._offsets
+        for i in xrange(bisect_right(ends, min_), len(ends)):
+            start = starts[i]
+            if start >= max_:
+                break
+            end = ends[i]
+            offset = offsets[i]
+            if start < min_:
+                offset += min_ - start
+                start = min_
+            if end > max_:
+                end = max_
+            yield start, end, offset
+
+    def get_slice(self, min_, max_=None):
+        """
+        get_slice returns only a sub-sequence, in original coordinates
+        """
+        region = normalize_slice(min_, max_, self._dna_size)
+        if region is None:
+            return ''
+        min_, max_ = region
+        str_as_array = array('c', 'N' * (max_ - min_))
+        for start, end, offset in self._iter_pieces(min_, max_):
+            str_as_array[start - min_:end - min_] = \
+                self._record.get_slice(offset, offset + end - start)
+        return str_as_array
+
+    def get_n_mask(self, min_=0, max_=None):
+        """
+        get_n_mask returns an array('B') with one entry per base in
+        [min_, max_), 1 where the base is an N or not stored
+        """
+        if min_ < 0:
+            min_ = 0
+        if max_ is None or max_ > self._dna_size:
+            max_ = self._dna_size
+        if max_ <= min_:
+            return array('B')
+        mask = array('B', [1]) * (max_ - min_)
+        for start, end, offset in self._iter_pieces(min_, max_):
+            mask[start - min_:end - min_] = \
+                self._record.get_n_mask(offset, offset + end - start)
+        return mask
+
+    def __str__(self):
+        """
+        returns the entire chromosome
+        """
+        return self.get_slice(0, None).tostring()
+
+
+# Suffix of the remapping table of a subset .2bit file
+REMAP_SUFFIX = '.map'
+
+
+def write_remap_table(filename, remap):
+    """
+    writes a remapping table for a subset .2bit file
+    remap is a dict: name -> (size, starts, ends, offsets), as described
+    in SubsetTwoBitSequence
+    The table is tab-delimited: name, size, start, end, offset
+    """
+    with open(filename, 'w') as ofp:
+        print >>ofp, '#%s' % '\t'.join(['name', 'size', 'start', 'end',
+                                        'offset'])
+        for name in sorted(remap):
+            size, starts, ends, offsets = remap[name]
+            for start, end, offset in izip(starts, ends, offsets):
+                print >>ofp, '%s\t%d\t%d\t%d\t%d' % (name, size, start,
+                                                     end, offset)
+
+
+def read_remap_table(filename):
+    """
+    reads a table written by write_remap_table
+    returns a dict: name -> (size, starts, ends, offsets)
+    """
+    remap = {}
+    with open(filename) as ifp:
+        for line in ifp:
+            if not line.strip() or line.startswith('#'):
+                continue
+            name, size, start, end, offset = line.split()
+            if name not in remap:
+                remap[name] = (int(size), array(LONG), array(LONG),
+                               array(LONG))
+            entry = remap[name]
+            entry[1].append(int(start))
+            entry[2].append(int(end))
+            entry[3].append(int(offset))
+    return remap
+
+
+# Packed 2-bit codes of each base (anything else is stored as T, in an N block)
+BASE_CODES = dict(zip('TCAGtcag', [0, 1, 2, 3] * 2))
+
+
+def pack_dna(seq):
+    """
+    returns seq packed to 2 bits per base (4 bases per byte, first base in
+    the most significant bits, the last byte padded with T), as stored in
+    the packedDna field of a .2bit file
+    """
+    if numpy is not None:
+        codes = numpy.zeros(256, dtype=numpy.uint8)
+        for base, code in BASE_CODES.iteritems():
+            codes[ord(base)] = code
+        bases = codes[numpy.frombuffer(seq, dtype=numpy.uint8)]
+        if len(bases) % 4:
+            bases = numpy.append(bases, numpy.zeros(4 - len(bases) % 4,
+                                                    dtype=numpy.uint8))
+        bases = bases.reshape(-1, 4)
+        packed = (bases[:, 0] << 6) | (bases[:, 1] << 4) | \
+                 (bases[:, 2] << 2) | bases[:, 3]
+        return packed.astype(numpy.uint8).tostring()
+    codes = [BASE_CODES.get(base, 0) for base in seq]
+    codes.extend([0] * (-len(codes) % 4))
+    return ''.join([chr((a << 6) | (b << 4) | (c << 2) | d)
+                    for a, b, c, d in izip(*[iter(codes)] * 4)])
+
+
+def _blocks(pattern, seq):
+    """returns arrays of the starts and sizes of matches of pattern"""
+    starts = array(LONG)
+    sizes = array(LONG)
+    for match in re.finditer(pattern, seq):
+        starts.append(match.start())
+        sizes.append(match.end() - match.start())
+    return starts, sizes
+
+
+def write_twobit(filename, sequences):
+    """
+    writes a .2bit file (in native byte order)
+    sequences is a list of (name, sequence) pairs. Each sequence can be a
+    string, or anything whose str() is one (such as a TwoBitSequence),
+    and is only converted when its record is written, so only one sequence
+    needs to be held in memory at a time.
+    Bases other than ACGT are stored as N blocks and lower case bases as
+    mask blocks.
+    """
+    names = [name for name, sequence in sequences]
+    for name in names:
+        if not 0 < len(name) < 256:
+            raise ValueError('Sequence names must be 1-255 characters')
+    with open(filename, 'wb') as ofp:
+        header = array(LONG, [0x1A412743, 0, len(names), 0])
+        ofp.write(header.tostring())
+        # reserve the index, which is filled in once the offsets are known
+        index_offset = ofp.tell()
+        ofp.write('\0' * sum([1 + len(name) + 4 for name in names]))
+        offsets = []
+        for name, sequence in sequences:
+            seq = str(sequence)
+            offsets.append(ofp.tell())
+            if offsets[-1] >= 2**32:
+                raise ValueError('2-bit files are limited to 4 GB')
+            n_block_starts, n_block_sizes = _blocks('[^ACGTacgt]+', seq)
+            mask_block_starts, mask_block_sizes = _blocks('[a-z]+', seq)
+            record = array(LONG, [len(seq), len(n_block_starts)])
+            record.extend(n_block_starts)
+            record.extend(n_block_sizes)
+            record.append(len(mask_block_starts))
+            record.extend(mask_block_starts)
+            record.extend(mask_block_sizes)
+            record.append(0)
+            ofp.write(record.tostring())
+            ofp.write(pack_dna(seq))
+        ofp.seek(index_offset)
+        for name, offset in izip(names, offsets):
+            ofp.write(chr(len(name)) + name + array(LONG, [offset]).tostring())
+
+
 class TwoBitFileError(StandardError):
     """
     Base exception for TwoBit module
@@ -553,6 +1186,10 @@ improves i/o performance on some machines.
 """
 
 
+# Number of BED lines twobit_reader fetches at a time
+READER_BATCH_SIZE = 10000
+
+
 def cmdline_reader():
     """
     cmdline_reader allows twobitreader module to be executed as a script
@@ -612,6 +1249,12 @@ def twobit_reader(twobit_file, input_stream=None, write=None):
     warning_msg = 'Invalid %s at line %d\n\t"%s"'
     if input_stream is None:
         return
+    if write is None:
+        def write(line):
+            print line
+    # regions are fetched in batches (see TwoBitFile.get_regions), so that
+    # overlapping and nearby regions share reads
+    batch = []
     for i, line in enumerate((line.rstrip('\n\r') for line in input_stream)):
         fields = line.split()
         if not len(fields) >= 3:
@@ -625,6 +1268,7 @@ def twobit_reader(twobit_file, input_stream=None, write=None):
             start = long(fields[1])
         except ValueError:
             logging.warn(warning_msg, 'start', i, line)
+            continue
         if start < 0:
             logging.warn(warning_msg, 'start', i, line)
             logging.warn('Using 0 as start instead for line %d', i)
@@ -641,14 +1285,20 @@ def twobit_reader(twobit_file, input_stream=None, write=None):
             logging.warn('Sequence will be truncated at chrom' +
                          'length for line %d', i)
             end = chrom_len
-        seq = twobit_file[chrom][start:end]
-        if write is not None:
-            write(">%s:%d-%d" % (chrom, start, end))
-            write(textwrap.fill(seq, 60))
-        else:
-            print ">%s:%d-%d" % (chrom, start, end)
-            print textwrap.fill(seq, 60)
+        batch.append((chrom, start, end))
+        if len(batch) >= READER_BATCH_SIZE:
+            _write_regions(twobit_file, batch, write)
+            batch = []
+    _write_regions(twobit_file, batch, write)
     return
 
+
+def _write_regions(twobit_file, regions, write):
+    """writes regions, fetched in one batch, in FASTA format"""
+    for (chrom, start, end), seq in izip(regions,
+                                         twobit_file.get_regions(regions)):
+        write(">%s:%d-%d" % (chrom, start, end))
+        write(textwrap.fill(seq, 60))
+
 if __name__ == '__main__':
     cmdline_reader()
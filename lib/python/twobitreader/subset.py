@@ -0,0 +1,142 @@
+"""
+Usage: python -m twobitreader.subset [options] GENOME.2bit OUT.2bit < REGIONS
+
+Writes OUT.2bit with only the given regions of GENOME.2bit, and the table
+(OUT.2bit.map) that TwoBitFile uses to read OUT.2bit with the coordinates of
+GENOME.2bit. Bases outside the regions read as N.
+
+REGIONS are read from stdin in BED format:
+chrom    start(0-based)    end(0-based, not included)
+
+For example, to keep every refGene transcript with 1 kb of flanking sequence:
+zcat refGene.ucsc.gz | cut -f 3,5,6 \\
+    | python -m twobitreader.subset --flank=1000 hg19.2bit hg19.refGene.2bit
+"""
+import logging
+import sys
+
+from twobitreader import TwoBitFile, REMAP_SUFFIX, write_twobit, \
+    write_remap_table
+
+
+class _Regions(object):
+    """
+    the stored sequence of a subset record: the given regions of sequence,
+    concatenated (only read when converted to a string)
+    """
+    def __init__(self, twobit_file, name, starts, ends):
+        self._twobit_file = twobit_file
+        self._name = name
+        self._starts = starts
+        self._ends = ends
+
+    def __str__(self):
+        regions = [(self._name, start, end)
+                   for start, end in zip(self._starts, self._ends)]
+        return ''.join(self._twobit_file.get_regions(regions))
+
+
+def merge_regions(regions, sizes, flank=0):
+    """
+    regions is an iterable of (chrom, start, end)
+    returns a dict: chrom -> sorted list of disjoint (start, end), with
+    flank bases added to each side and clipped to the chrom size (sizes)
+    """
+    by_chrom = {}
+    for chrom, start, end in regions:
+        start = max(0, start - flank)
+        end = min(sizes[chrom], end + flank)
+        if start < end:
+            by_chrom.setdefault(chrom, []).append((start, end))
+    merged = {}
+    for chrom, intervals in by_chrom.iteritems():
+        intervals.sort()
+        result = [list(intervals[0])]
+        for start, end in intervals[1:]:
+            if start <= result[-1][1]:
+                result[-1][1] = max(result[-1][1], end)
+            else:
+                result.append([start, end])
+        merged[chrom] = [tuple(interval) for interval in result]
+    return merged
+
+
+def write_subset(twobit_file, filename, regions, flank=0):
+    """
+    writes the regions (see merge_regions) of twobit_file to filename,
+    along with its remapping table
+    returns the number of bases stored
+    """
+    sizes = twobit_file.sequence_sizes()
+    merged = merge_regions(regions, sizes, flank=flank)
+    remap = {}
+    sequences = []
+    n_bases = 0
+    for chrom in sorted(merged):
+        starts = [start for start, end in merged[chrom]]
+        ends = [end for start, end in merged[chrom]]
+        offsets = []
+        offset = 0
+        for start, end in merged[chrom]:
+            offsets.append(offset)
+            offset += end - start
+        n_bases += offset
+        remap[chrom] = (sizes[chrom], starts, ends, offsets)
+        sequences.append((chrom, _Regions(twobit_file, chrom, starts, ends)))
+    write_twobit(filename, sequences)
+    write_remap_table(filename + REMAP_SUFFIX, remap)
+    return n_bases
+
+
+def iter_bed(input_stream, twobit_file):
+    """yields (chrom, start, end) from BED lines, skipping invalid ones"""
+    warning_msg = 'Invalid %s at line %d\n\t"%s"'
+    for i, line in enumerate(input_stream):
+        line = line.rstrip('\n\r')
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) < 3:
+            logging.warn(warning_msg, 'region', i, line)
+            continue
+        if fields[0] not in twobit_file:
+            logging.warn(warning_msg, 'chrom', i, line)
+            continue
+        try:
+            start, end = int(fields[1]), int(fields[2])
+        except ValueError:
+            logging.warn(warning_msg, 'coordinates', i, line)
+            continue
+        yield fields[0], start, end
+
+
+def parse_args(args):
+    from optparse import OptionParser
+    usage = "usage: %prog [options] GENOME.2bit OUT.2bit < REGIONS"
+    description = __doc__.strip()
+
+    parser = OptionParser(usage=usage,
+                          description=description)
+    parser.add_option("--flank", metavar="N", type="int",
+                      dest="flank", default=0,
+                      help="Also keep N bases on either side of each region")
+    options, args = parser.parse_args(args)
+
+    if len(args) != 2:
+        parser.error("Inappropriate number of arguments")
+
+    return options, args
+
+
+def main(args=sys.argv[1:]):
+    options, args = parse_args(args)
+    genome_filename, out_filename = args
+    twobit_file = TwoBitFile(genome_filename, use_mmap=True)
+    n_bases = write_subset(twobit_file, out_filename,
+                           iter_bed(sys.stdin, twobit_file),
+                           flank=options.flank)
+    print >>sys.stderr, "Wrote %d of %d bases to: %s" % \
+        (n_bases, sum(twobit_file.sequence_sizes().values()), out_filename)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,7 +8,7 @@ export SILVA_AF_MAX=0.05
 control=$SILVA_CONTROL.mat
 src=$SILVA_PATH/src
 data=$SILVA_PATH/data
-synonymous="$src/input/synonymous.py --genome=$data/hg19.2bit --genes=$data/refGene.ucsc.gz --cache-genes=$data/refGene.pkl"
+synonymous="$src/input/synonymous.py --genome=$data/hg19.2bit --genes=$data/refGene.ucsc.gz --cache-genes=$data/refGene.genes"
 gp1k="$src/input/1000gp.py $data/1000gp.refGene.vcf.gz $data/1000gp.refGene.pkl"
 
 function usage {
@@ -69,7 +69,7 @@ else
 fi
 skip_if_exists $outdir/$out \
     && echo "Filtering for synonymous exonic variants..." >&2 \
-    && $synonymous filter $pcoord "$vcf" | egrep -v "^Y\b" > $TMPDIR/$out \
+    && $synonymous filter --jobs=$SILVA_N_THREADS $pcoord "$vcf" | egrep -v "^Y\b" > $TMPDIR/$out \
     && echo "Removing variants on chromosome Y..." >&2 \
     && mv $TMPDIR/$out $outdir/$out \
     && echo "Left with $(grep -v '^#' $outdir/$out | wc -l) variants..." >&2
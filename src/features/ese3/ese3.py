@@ -6,6 +6,7 @@ splice enhancers (ESEs). Input sequences are read, one per line.
 Sequences should be at least 15 nucleotides long, with 7 bases 5',
 the mutated nucleotide: [OLD/NEW], and 7 bases 3'. For example:
 AAGAGGT[C/G]TCGTTTACGGAGG. Suggested input is the full exon.
+With pipe-delimited or compact (silva.context) input, the mutated exon is used.
 """
 
 # Author: Orion Buske
@@ -21,6 +22,7 @@ assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from silva.context import MutationContext
 
 PRE_LEN = 7
 POST_LEN = 7
@@ -35,9 +37,7 @@ def iter_sequences(filename):
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             seq = line.strip().upper()
-            mut_exons = [chunk for chunk in seq.split('|') if '/' in chunk]
-            assert len(mut_exons) == 1
-            exon = mut_exons[0]
+            exon = MutationContext.parse(seq).block()
             m = seq_re.search(exon)
             if m:
                 pre, old, new, post = m.groups()
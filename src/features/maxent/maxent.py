@@ -3,7 +3,8 @@
 """
 Input sequences are read, one per line, of the form: AAGA[C/G]TCG.
 If possible, the sequence should include the entire exon (or more,
-with pipes marking all splice junctions).
+with pipes marking all splice junctions), or be a compact context
+(see silva.context).
 """
 
 # Author: Orion Buske
@@ -23,6 +24,7 @@ assert os.getenv('SILVA_PATH') is not None, \
            "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from silva.context import MutationContext
 
 MAXENT_PATH = os.path.expandvars('$SILVA_PATH/tools/maxent')
 GOOD_SCORE = 2
@@ -40,32 +42,12 @@ class Seq(object):
         Given full sequence, find known and canonical splice sites (indices)
         and relevant subsequence (str)
         """
-        assert seq.count('/') == 1
         seq = seq.strip().upper()
-        chunks = seq.split('|')
-        mut_offset = None
-        for i, chunk in enumerate(chunks):
-            if '/' in chunk:
-                if i == 0:
-                    pre = ''
-                else:
-                    pre_merge = ''.join(chunks[:i])
-                    pre = pre_merge[-self.before[3]:]
-
-                if i == len(chunks) - 1:
-                    post = ''
-                else:
-                    post_merge = ''.join(chunks[i+1:])
-                    post = post_merge[:self.after[5]]
-                    
-                m = self.seq_re.match(chunk)
-                assert m
-                head, nuc_old, nuc_new, tail = m.groups()
-                mut_offset = len(pre) + len(head)
-                
-                break
-
-        assert mut_offset is not None
+        context = MutationContext.parse(seq)
+        pre, post = context.flanks(self.before[3], self.after[5])
+        m = self.seq_re.match(context.block())
+        assert m
+        head, nuc_old, nuc_new, tail = m.groups()
         self._old_seq = pre + head + nuc_old + tail + post
         self._new_seq = pre + head + nuc_new + tail + post
         # Given splice junctions
@@ -7,6 +7,7 @@ obs/exp CpG ratio.
 
 Input mutation should be of the form:
 ACACAGGGTTT[A/C]CAAACCGAGCG
+(pipe-delimited or compact contexts, see silva.context, are read too)
 """
 
 # Author: Orion Buske
@@ -22,16 +23,14 @@ assert os.getenv('SILVA_PATH') is not None, \
            "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 from silva import maybe_gzip_open, print_args
+from silva.context import MutationContext
 
 def iter_sequences(filename):
     seq_re = re.compile(r'([ACGT]*)\[([ACGT])/([ACGT])\]([ACGT]*)')
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             seq = line.strip().upper().translate(None, 'N')
-            chunks = line.split('|')
-            mut_seqs = [chunk for chunk in chunks if '/' in chunk]
-            assert len(mut_seqs) == 1
-            exon = mut_seqs[0]
+            exon = MutationContext.parse(line).block()
             m = seq_re.match(exon)
             if m:
                 pre, old, new, post = m.groups()
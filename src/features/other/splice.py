@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 """
-Input sequences are read, one per line, of the form: GGAG|AAGA[C/G]TCG.
+Input sequences are read, one per line, of the form: GGAG|AAGA[C/G]TCG,
+or as compact contexts (see silva.context).
 Prints splicing-related numbers. Mutation must be in exon.
 """
 
@@ -18,6 +19,7 @@ assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 from silva import maybe_gzip_open, print_args
+from silva.context import MutationContext
 
 def script(filename, quiet=False, verbose=False, **kwargs):
     fields = ['f_premrna', 'f_mrna']  #, 'splice_dist']
@@ -25,24 +27,18 @@ def script(filename, quiet=False, verbose=False, **kwargs):
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             line = line.strip().upper()
-            assert line.count('/') == 1
 
-            pre, post = line.split('/')
-            # Trim off mutation nucs and brackets
-            pre = pre[:-2]  # e,g, '[A'
-            post = post[2:]  # e.g. 'C]'
-
-            pre_chunks = pre.split('|')
-            post_chunks = post.split('|')
+            context = MutationContext.parse(line)
+            pre, post = context.premrna_lengths()
+            # Count the pipes either side, as when this read the pipe form
+            pre += context.index
+            post += len(context.lengths) - 1 - context.index
             # Assume mutation is in exon
 
-            premrna_f = min(len(pre), len(post)) \
-                           / (len(pre) + len(post) + 1)
-            pre_cds = ''.join(pre_chunks[::2])
-            post_cds = ''.join(post_chunks[::2])
-            mrna_f = min(len(pre_cds), len(post_cds)) \
-                        / (len(pre_cds) + len(post_cds) + 1)
-            #splice_dist = min(len(pre_chunks[-1]), len(post_chunks[0]))
+            premrna_f = min(pre, post) / (pre + post + 1)
+            pre_cds, post_cds = context.mrna_lengths()
+            mrna_f = min(pre_cds, post_cds) / (pre_cds + post_cds + 1)
+            #splice_dist = min(context.block_lengths())
 
             print '%.4f\t%.4f' % (premrna_f, mrna_f) #, splice_dist)
 
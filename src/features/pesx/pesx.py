@@ -6,7 +6,8 @@ splice enhancers and supressors (ESEs and ESSs) based upon
 octamer subsequences.
 Input sequences are read, one per line, of the form: AAGA[C/G]TCG.
 If possible, input sequence should be full exon or more (with splice
-junctions marked with pipe characters).
+junctions marked with pipe characters), or a compact context from
+'synonymous.py annotate' (see silva.context).
 """
 
 # Author: Orion Buske
@@ -22,6 +23,7 @@ assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from silva.context import MutationContext
 
 def octamer_subsequences(octs, seq):
     """Return dict: pos -> octamer found in seq"""
@@ -62,9 +64,7 @@ def iter_sequences(filename):
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             seq = line.strip().upper()
-            mut_exons = [chunk for chunk in seq.split('|') if '/' in chunk]
-            assert len(mut_exons) == 1
-            exon = mut_exons[0]
+            exon = MutationContext.parse(seq).block()
             m = seq_re.search(exon)
             if m:
                 pre, old, new, post = m.groups()
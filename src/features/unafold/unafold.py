@@ -2,6 +2,8 @@
 
 """
 Input sequences are read, one per line, of the form: AAGA[C/G]TCG
+or as compact contexts (see silva.context), which hold enough sequence
+for a domain (-d) of up to 50.
 """
 
 # Author: Orion Buske
@@ -20,6 +22,7 @@ assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from silva.context import MutationContext
 
 BIN = os.path.expandvars("$SILVA_PATH/tools/unafold/src/hybrid-ss-min")
 DATA = os.path.expandvars("$SILVA_PATH/tools/unafold/data")
@@ -60,8 +63,9 @@ def iter_sequences(filename, domain=None, **kwargs):
         for line in ifp:
             seq = line.strip().upper()
             try:
-                premrna = seq.replace('|', '')
-                postmrna = ''.join(seq.split('|')[::2])
+                context = MutationContext.parse(seq)
+                premrna = context.premrna()
+                postmrna = context.mrna()
                 yield get_mut_seqs(premrna), get_mut_seqs(postmrna)
             except (ValueError, AssertionError):
                 print >>sys.stderr, "Error, invalid sequence: %s" % seq
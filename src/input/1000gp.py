@@ -17,14 +17,12 @@ from __future__ import with_statement, division
 
 import os
 import sys
-import cPickle
-
-from collections import defaultdict
 
 assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
-from silva import maybe_gzip_open
+from silva.allelefreq import load_af_table, format_af
+from silva.vcf import split_fields
 
 args = sys.argv[1:]
 
@@ -42,59 +40,11 @@ else:
     
 tablefile = args[0]
 
-def read_table(filename, optfile=None):
-    data = defaultdict(dict)
-    with maybe_gzip_open(filename) as ifp:
-        for line in ifp:
-            line = line.strip()
-            if not line or line.startswith('#'): continue
-            tokens = line.split('\t')
-            chrom, pos = tokens[:2]
-            alt = tokens[4].split(',')[0]
-            info = tokens[7]
-            # Split AC and AN from INFO field
-            fields = info.split(';')
-            fields.sort()
-            ac = an = None
-            for field in fields:
-                if field.startswith('AC='):
-                    ac = int(field.split('=')[1])
-                    if an is not None:
-                        break
-                elif field.startswith('AN='):
-                    an = int(field.split('=')[1])
-                    if ac is not None:
-                        break
-
-            assert ac is not None and an is not None, \
-                   "Error: entry with AC and AN: %s" % line
-            
-            data[chrom.lstrip('chr')][(int(pos), alt)] = float(ac) / an
-
-    if optfile and not os.path.isfile(optfile):
-        print >>sys.stderr, "Saving optimized table to:", optfile
-        with maybe_gzip_open(optfile, 'wb') as ofp:
-            cPickle.dump(data, ofp, cPickle.HIGHEST_PROTOCOL)
-
-    return data
-
-
-if optfile and os.path.isfile(optfile):
-    print >>sys.stderr, "Loading optimized table from:", optfile
-    with maybe_gzip_open(optfile, 'rb') as ifp:
-        table = cPickle.load(ifp)
-else:
-    print >>sys.stderr, "Loading table from:", tablefile
-    table = read_table(tablefile, optfile)
+table = load_af_table(tablefile, optfile)
 
 print '#1000GP_AF'
 for line in sys.stdin:
     line = line.strip()
     if not line or line.startswith('#'): continue
-    chrom, pos, alt = line.split()
-    try:
-        value = '%.4f' % table[chrom.lstrip('chr')][(int(pos), alt)]
-    except (IndexError, KeyError):
-        value = '.'
-        
-    print value
+    chrom, pos, alt = split_fields(line, 3)[0]
+    print format_af(table, chrom, pos, alt)
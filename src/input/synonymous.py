@@ -9,10 +9,18 @@ which the variant is synonymous).
 If ACTION is 'annotate' or 'generate', VARIANTS should contain the 7 columns
 outputted by first 'filter'ing. 
 If ACTION is 'annotate', additional columns are added: strand, codon, 
-codon_offset, and pre-mRNA sequence.
+codon_offset, and the sequence context of the variant (compact, see
+silva.context, or the entire pre-mRNA with --full-context).
 If ACTION is 'generate', either random (--random) or all (--all) synonymous
 variants are generated and printed to stdout. With --random, variants are
 gene-matched, and additional flags allow matching other dimensions.
+If ACTION is 'preprocess', VARIANTS are filtered, their allele frequencies
+are looked up (--af-table), and those in [--af-min, --af-max] are annotated,
+in a single pass. The output is as 'annotate', and the outputs of the
+separate steps can be written too (--syn-out, --af-out, --flt-out).
+With --payload, 'filter' and 'preprocess' write the VCF columns after alt
+(e.g. genotypes) to a side file instead, leaving just the record number in
+a last column, 'payload' (see silva.payload).
 """
 
 # Author: Orion Buske
@@ -23,15 +31,27 @@ import os
 import sys
 import cPickle
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from multiprocessing import Pool
+from bisect import bisect_right
+from array import array
 from string import maketrans
-from random import sample
+from random import Random, randrange
+
+import numpy as np
 
 assert os.getenv('SILVA_PATH') is not None, \
     "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 
-from silva import maybe_gzip_open
+from silva import maybe_gzip_open, bgzf
+from silva.genestore import GeneStore, GeneStoreWriter, is_gene_store
+from silva.intervals import IntervalIndex, IntervalSweep
+from silva.sitetable import write_header, encode_sites
+from silva.context import MutationContext
+from silva.allelefreq import load_af_table, format_af, af_in_range
+from silva.vcf import split_fields, join_fields, iter_records
+from silva.payload import PayloadWriter, PAYLOAD_FIELD
 from twobitreader import TwoBitFile as Genome
 
 STOP = '*'
@@ -67,11 +87,82 @@ for codon, aa in AA_CODE.iteritems():
 COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
 COMPLEMENT_TAB = maketrans('ACGT', 'TGCA')
 
+# Lookup arrays for batch classification: byte -> nucleotide code (0-3,
+# or -1 if not ACGT), and codon code (16 * n1 + 4 * n2 + n3) -> amino acid
+NUC_CODE = np.empty(256, dtype=np.int8)
+NUC_CODE.fill(-1)
+for i, nuc in enumerate('ACGT'):
+    NUC_CODE[ord(nuc)] = i
+CODON_AA = np.zeros(64, dtype=np.uint8)
+for codon, aa in AA_CODE.iteritems():
+    CODON_AA[16 * NUC_CODE[ord(codon[0])] + 4 * NUC_CODE[ord(codon[1])] +
+             NUC_CODE[ord(codon[2])]] = ord(aa)
+# codon code, frame, alt nucleotide code -> is the mutation synonymous?
+SYN_MUTATION_MASK = np.zeros((64, 3, 4), dtype=bool)
+for codon, mutations in SYN_MUTATIONS.iteritems():
+    for frame, alt in mutations:
+        SYN_MUTATION_MASK[16 * NUC_CODE[ord(codon[0])] +
+                          4 * NUC_CODE[ord(codon[1])] +
+                          NUC_CODE[ord(codon[2])],
+                          frame, NUC_CODE[ord(alt)]] = True
+
+class SeqCache(object):
+    """Bounds the number of transcripts holding sequence loaded from their
+    seq_source: once more than max_size have, the sequence of the least
+    recently used one is dropped (and loaded again if it is needed again)
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._txs = OrderedDict()
+        self.n_loaded = 0
+
+    def __len__(self):
+        return len(self._txs)
+
+    def touch(self, tx):
+        try:
+            del self._txs[tx]
+        except KeyError:
+            self.n_loaded += 1
+        self._txs[tx] = True
+        while len(self._txs) > self.max_size:
+            old_tx = self._txs.popitem(last=False)[0]
+            old_tx.unload_seq()
+
+class SeqSpan(object):
+    """Genomic (+ strand) sequence starting at start (0-indexed), shared by
+    the overlapping transcripts of a locus as their seq_source
+    """
+    def __init__(self, seq, start):
+        self.seq = seq
+        self.start = start
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __call__(self):
+        return self.seq, self.start
+
 class Transcript(object):
+    # Coordinates are kept in arrays, and there is no per-instance __dict__,
+    # since the whole transcriptome is loaded at once
+    __slots__ = ['_valid', '_chrom', '_strand', '_gene', '_tx',
+                 '_tx_start', '_tx_end', '_tx_length',
+                 '_cds_start', '_cds_end', '_cds_length',
+                 '_exon_starts', '_exon_ends', '_cds_starts', '_cds_ends',
+                 '_cds_cum', '_edges',
+                 '_mrna', '_premrna', '_seq_source', '_seq_cache']
+
     def __init__(self, gene, tx, chrom, tx_start, tx_end, strand, 
-                 cds_start, cds_end, exon_starts, exon_ends, seq=None):
+                 cds_start, cds_end, exon_starts, exon_ends, seq=None,
+                 seq_offset=0, seq_source=None, seq_cache=None):
         """
         starts and ends: 0-indexed half-open
+        seq, if provided, is passed to load_seq along with seq_offset
+        seq_source, if provided, is called with no arguments the first time
+        the sequence is needed, and returns (seq, seq_offset) for load_seq
+        seq_cache, if provided, is a SeqCache bounding how many transcripts
+        keep sequence loaded from their seq_source
         """
         self._valid = False
         self._chrom = chrom
@@ -83,7 +174,6 @@ class Transcript(object):
         self._tx_end = int(tx_end)
         self._tx_length = self._tx_end - self._tx_start
 
-        self._cds = []
         self._cds_start = int(cds_start)
         self._cds_end = int(cds_end)
         self._mrna = None
@@ -95,27 +185,32 @@ class Transcript(object):
         assert self._strand == '+' or self._strand == '-', \
                "Invalid strand: %s" % self._strand
 
-        exon_starts = [int(x) for x in exon_starts]
-        exon_ends = [int(x) for x in exon_ends]
-        assert len(exon_starts) == len(exon_ends), \
+        self._exon_starts = array('l', [int(x) for x in exon_starts])
+        self._exon_ends = array('l', [int(x) for x in exon_ends])
+        assert len(self._exon_starts) == len(self._exon_ends), \
             "Different number of exon starts and ends"
-        self._exons = zip(exon_starts, exon_ends)
 
         #print >>sys.stderr, "TX:  0 - %d" % (self._tx_length)
         #print >>sys.stderr, "CDS: %d - %d" % (self._cds_start - self._tx_start, self._cds_end - self._tx_start)
-        for exon_start, exon_end in self._exons:
+        self._cds_starts = array('l')
+        self._cds_ends = array('l')
+        for exon_start, exon_end in zip(self._exon_starts, self._exon_ends):
             #print >>sys.stderr, "Exon: %d - %d" % (b_start, b_start + b_len)
             cds_start = max(exon_start, self._cds_start)
             cds_end = min(exon_end, self._cds_end)
             if cds_start < cds_end:
-                self._cds.append((cds_start, cds_end))
+                self._cds_starts.append(cds_start)
+                self._cds_ends.append(cds_end)
 
-        assert self._cds, "Empty CDS"
-        self._cds_length = sum([end - start for start, end in self._cds])
+        assert self._cds_starts, "Empty CDS"
+        self._cds_length = sum(self._cds_ends) - sum(self._cds_starts)
         assert self._cds_length % 3 == 0, "CDS length not a multiple of 3"
+        self._init_geometry()
 
+        self._seq_source = seq_source
+        self._seq_cache = seq_cache
         if seq is not None:
-            self.load_seq(seq)
+            self.load_seq(seq, seq_offset)
 
         self._valid = True
 
@@ -129,6 +224,60 @@ class Transcript(object):
     def __repr__(self):
         return "<Transcript: %s>" % (self)
 
+    @property
+    def _exons(self):
+        """List of (start, end) exon intervals"""
+        return zip(self._exon_starts, self._exon_ends)
+
+    @property
+    def _cds(self):
+        """List of (start, end) CDS intervals, in genomic order"""
+        return zip(self._cds_starts, self._cds_ends)
+
+    def _init_geometry(self):
+        """Precompute the arrays used for projection and mutation_str"""
+        # The total length of the CDS intervals before each
+        self._cds_cum = array('l')
+        cum = 0
+        for start, end in self._cds:
+            self._cds_cum.append(cum)
+            cum += end - start
+
+        # Sorted premrna offsets of all edges between exons and introns
+        edges = set([0, self._tx_length])
+        edges.update([start - self._tx_start for start in self._exon_starts])
+        edges.update([end - self._tx_start for end in self._exon_ends])
+        if self._strand == '-':
+            edges = [self._tx_length - e for e in edges]
+        self._edges = array('l', sorted(edges))
+
+    def __setstate__(self, state):
+        state = dict(state)
+        if '_exons' in state:
+            # Pickled before coordinates were kept in arrays
+            exons = state.pop('_exons')
+            cds = state.pop('_cds')
+            state['_exon_starts'] = array('l', [start for start, end in exons])
+            state['_exon_ends'] = array('l', [end for start, end in exons])
+            state['_cds_starts'] = array('l', [start for start, end in cds])
+            state['_cds_ends'] = array('l', [end for start, end in cds])
+            state.pop('_cds_cum', None)
+            state.pop('_edges', None)
+
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+        if self._cds_cum is None:
+            self._init_geometry()
+
+    def __getstate__(self):
+        # Sequence that can be loaded from seq_source is not pickled
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        del state['_seq_cache']
+        if self._seq_source is not None:
+            state['_mrna'] = None
+            state['_premrna'] = None
+        return state
+
     def valid(self):
         return self._valid
     
@@ -147,34 +296,37 @@ class Transcript(object):
     def strand(self):
         return self._strand
 
+    def _load_seq_source(self):
+        if self._seq_source is None:
+            return
+        if self._mrna is None:
+            self.load_seq(*self._seq_source())
+        if self._seq_cache is not None:
+            self._seq_cache.touch(self)
+
+    def unload_seq(self):
+        """Drop sequence that can be loaded again from seq_source"""
+        if self._seq_source is not None:
+            self._mrna = None
+            self._premrna = None
+
     def cds(self):
+        self._load_seq_source()
         return self._mrna
 
     def premrna(self):
+        self._load_seq_source()
         return self._premrna
 
-    def _project_to_intervals(self, pos, intervals):
-        """Return interval offset (0-indexed), given genome pos (1-indexed)
-        intervals are 0-indexed, half-open
+    def _genomic_cds_offset(self, pos):
+        """Return offset (0-indexed) into the CDS intervals in genomic
+        order, given genome pos (1-indexed), or None if not within them
         """
-        offset = 0
-        if self._strand == '+':
-            for start, end in intervals:
-                if start < pos <= end:
-                    return offset + (pos - (start + 1))
-                elif pos < start + 1:
-                    return None
-                else:
-                    offset += (end - start)
-        else:
-            for start, end in reversed(intervals):
-                if start < pos <= end:
-                    return offset + (end - pos)
-                elif pos > end:
-                    return None
-                else:
-                    offset += (end - start)
-        
+        i = bisect_right(self._cds_starts, pos - 1) - 1
+        if i < 0 or pos > self._cds_ends[i]:
+            return None
+        return self._cds_cum[i] + (pos - 1 - self._cds_starts[i])
+
     def project_to_premrna(self, pos):
         """Return premrna offset (0-indexed), given genome pos (1-indexed)"""
         assert self._tx_start < pos <= self._tx_end
@@ -188,31 +340,10 @@ class Transcript(object):
         assert self._cds_start < pos <= self._cds_end, \
                "Error, pos (%r) outside of CDS: [%r, %r)" % \
                (pos, self._cds_start, self._cds_end)
-        return self._project_to_intervals(pos, self._cds)
-
-    def _project_from_intervals(self, offset, intervals):
-        """
-        Return genome position (1-indexed), given interval offset (0-indexed)
-        and 0-indexed, half-open intervals
-        """
-        if self._strand == '+':
-            for start, end in intervals:
-                size = end - start
-                if offset < 0:
-                    return None
-                elif offset < size:
-                    return start + offset + 1
-                else:
-                    offset -= size
-        else:
-            for start, end in reversed(intervals):
-                size = end - start
-                if offset < 0:
-                    return None
-                elif offset < size:
-                    return end - offset
-                else:
-                    offset -= size
+        offset = self._genomic_cds_offset(pos)
+        if offset is not None and self._strand == '-':
+            offset = self._cds_length - 1 - offset
+        return offset
 
     def project_from_premrna(self, offset):
         """Return genome position (1-indexed), given premrna offset (0-indexed)"""
@@ -225,17 +356,79 @@ class Transcript(object):
     def project_from_cds(self, offset):
         """Return genome position (1-indexed), given cds offset (0-indexed)"""
         assert 0 <= offset < self._cds_length
-        return self._project_from_intervals(offset, self._cds)
+        if self._strand == '-':
+            offset = self._cds_length - 1 - offset
+        i = bisect_right(self._cds_cum, offset) - 1
+        return self._cds_starts[i] + (offset - self._cds_cum[i]) + 1
+
+    def project_to_cds_array(self, positions):
+        """Return an array of cds offsets (0-indexed, -1 if not in the CDS),
+        given an array of genome positions (1-indexed)
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = np.array(self._cds_starts)
+        cum = np.array(self._cds_cum)
+        i = np.searchsorted(starts, positions - 1, 'right') - 1
+        valid = (i >= 0)
+        i = np.maximum(i, 0)
+        valid &= positions <= np.array(self._cds_ends)[i]
+        offsets = cum[i] + (positions - 1 - starts[i])
+        if self._strand == '-':
+            offsets = self._cds_length - 1 - offsets
+        return np.where(valid, offsets, -1)
+
+    def project_from_cds_array(self, offsets):
+        """Return an array of genome positions (1-indexed), given an array
+        of cds offsets (0-indexed)
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        assert ((0 <= offsets) & (offsets < self._cds_length)).all()
+        if self._strand == '-':
+            offsets = self._cds_length - 1 - offsets
+        cum = np.array(self._cds_cum)
+        i = np.searchsorted(cum, offsets, 'right') - 1
+        return np.array(self._cds_starts)[i] + (offsets - cum[i]) + 1
+
+    def project_to_premrna_array(self, positions):
+        """Return an array of premrna offsets (0-indexed), given an array
+        of genome positions (1-indexed)
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        assert ((self._tx_start < positions) &
+                (positions <= self._tx_end)).all()
+        if self._strand == '+':
+            return positions - self._tx_start - 1
+        else:
+            return self._tx_end - positions
+
+    def project_from_premrna_array(self, offsets):
+        """Return an array of genome positions (1-indexed), given an array
+        of premrna offsets (0-indexed)
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        assert ((0 <= offsets) & (offsets < self._tx_length)).all()
+        if self._strand == '+':
+            return self._tx_start + offsets + 1
+        else:
+            return self._tx_end - offsets
     
-    def load_seq(self, seq):
+    def load_seq(self, seq, offset=0):
+        """Load pre-mRNA and mRNA sequence from seq, which covers the
+        transcript and starts at genomic position offset (0-indexed),
+        e.g. a whole chromosome with offset 0
+        """
         assert seq is not None, "seq is None"
         stop_codons = set(['TAA', 'TAG', 'TGA'])
 
-        premrna = seq[self._tx_start:self._tx_end].tostring().upper()
+        premrna = seq[self._tx_start - offset:self._tx_end - offset]
+        if not isinstance(premrna, str):
+            premrna = premrna.tostring()
+        premrna = premrna.upper()
 
+        # CDS exons are sliced from the pre-mRNA, not read again
         seqs = []
         for start, end in self._cds:
-            seqs.append(seq[start:end].tostring().upper())
+            seqs.append(premrna[start - self._tx_start:end - self._tx_start])
 
         if self._strand == '-':
             premrna = premrna.translate(COMPLEMENT_TAB)[::-1]
@@ -247,58 +440,77 @@ class Transcript(object):
         assert len(self._mrna) == self._cds_length, "mRNA length != CDS length"
         assert self._mrna[-3:] in stop_codons, \
                "Transcript ends with : %s" % self._mrna[-3:]
+
+    def check_stop_codon(self, seq, offset=0):
+        """Check that the CDS ends with a stop codon, as load_seq does, but
+        reading only the stop codon from seq (as for load_seq)
+        """
+        stop_codons = set(['TAA', 'TAG', 'TGA'])
+        positions = [self.project_from_cds(i) for i in
+                     xrange(self._cds_length - 3, self._cds_length)]
+        start = min(positions) - 1
+        span = seq[start - offset:max(positions) - offset]
+        if not isinstance(span, str):
+            span = span.tostring()
+        codon = ''.join([span[pos - 1 - start] for pos in positions]).upper()
+        if self._strand == '-':
+            codon = codon.translate(COMPLEMENT_TAB)
+        assert codon in stop_codons, "Transcript ends with : %s" % codon
     
     def get_codon(self, aa):
         """Get codon at amino acid position (1-indexed)"""
-        assert self._mrna is not None
+        mrna = self.cds()
+        assert mrna is not None
         start = (aa - 1) * 3
-        return self._mrna[start:start+3]
+        return mrna[start:start+3]
 
-    def mutation_str(self, pos, ref, alt):
-        """Given genomic pos (1-indexed), ref nuc and alt nuc, return
-        mrna string in 'standard' form: ACT|ACGCACA[G/T]|ACAACA
-
-        Splice sites are marked with pipes, mutation is in brackets
+    def _mutation_offset(self, pos, ref, alt):
+        """Return the premrna offset of genomic pos (1-indexed), and ref
+        and alt on the transcript strand
         """
-        premrna = self._premrna
-        assert premrna
-
         # Make nucs tx strand
         if self._strand == '-':
             alt = COMPLEMENT[alt]
             ref = COMPLEMENT[ref]
         
         mut_offset = self.project_to_premrna(pos)
-        assert premrna[mut_offset] == ref, \
+        assert self.premrna()[mut_offset] == ref, \
                "Found %s insead of %s as ref at pos %d in %s" % \
-               (ref, premrna[mut_offset], pos, self)
+               (ref, self.premrna()[mut_offset], pos, self)
+        return mut_offset, ref, alt
 
-        # Set of all edges between exons and introns
-        edges = set([0, self._tx_length])
-        edges.update([start - self._tx_start for start, end in self._exons])
-        edges.update([end - self._tx_start for start, end in self._exons])
-        
-        if self._strand == '-':
-            edges = [self._tx_length - e for e in edges]
-            
-        edges = list(sorted(edges))
-        
-        seqs = []
-        for start, end in zip(edges[:-1], edges[1:]):
-            seqs.append(premrna[start:end])
-
-        # find sequence block with mutation
-        for i, seq in enumerate(seqs):
-            if mut_offset < len(seq):
-                # insert mutation
-                assert seq[mut_offset] == ref
-                seqs[i] = '%s[%s/%s]%s' % (seq[:mut_offset], ref, alt, seq[mut_offset+1:])
-                break
-            else:
-                mut_offset -= len(seq)
+    def mutation_str(self, pos, ref, alt):
+        """Given genomic pos (1-indexed), ref nuc and alt nuc, return
+        mrna string in 'standard' form: ACT|ACGCACA[G/T]|ACAACA
+
+        Splice sites are marked with pipes, mutation is in brackets
+        """
+        premrna = self.premrna()
+        assert premrna
+        mut_offset, ref, alt = self._mutation_offset(pos, ref, alt)
+
+        # Sequence blocks between exon/intron edges, split at the mutation
+        edges = self._edges
+        i = bisect_right(edges, mut_offset)
+        before = [premrna[start:end]
+                  for start, end in zip(edges[:i - 1], edges[1:i])]
+        after = [premrna[start:end]
+                 for start, end in zip(edges[i:-1], edges[i + 1:])]
+        block = '%s[%s/%s]%s' % (premrna[edges[i - 1]:mut_offset], ref, alt,
+                                 premrna[mut_offset + 1:edges[i]])
 
         # add splice markers
-        return '|'.join(seqs)
+        return '|'.join(before + [block] + after)
+
+    def mutation_context(self, pos, ref, alt):
+        """Like mutation_str, but return a compact MutationContext, with
+        only the sequence near the mutation (see silva.context)
+        """
+        premrna = self.premrna()
+        assert premrna
+        mut_offset, ref, alt = self._mutation_offset(pos, ref, alt)
+        return MutationContext.from_premrna(premrna, self._edges, mut_offset,
+                                            ref, alt)
 
     def is_synonymous(self, pos, ref, alt):
         """Is ref -> alt at pos (1-indexed, genomic) a synonymous change?"""
@@ -313,16 +525,58 @@ class Transcript(object):
             alt = COMPLEMENT[alt]
             ref = COMPLEMENT[ref]
 
-        assert self._mrna[cds_pos] == ref, \
+        mrna = self.cds()
+        assert mrna[cds_pos] == ref, \
                "Reference mismatch: %s:%s (%s)  %s != %s" % \
-               (self._chrom, pos, self._strand, self._mrna[cds_pos], ref)
+               (self._chrom, pos, self._strand, mrna[cds_pos], ref)
         
         frame = cds_pos % 3
         codon_start = cds_pos - frame
-        old_codon = self._mrna[codon_start:codon_start+3]
+        old_codon = mrna[codon_start:codon_start+3]
         new_codon = old_codon[:frame] + alt + old_codon[frame+1:]
         return AA_CODE[old_codon] == AA_CODE[new_codon]
 
+    def is_synonymous_array(self, positions, refs, alts):
+        """Return a boolean array: is each refs[i] -> alts[i] at positions[i]
+        (1-indexed, genomic) a synonymous change?
+
+        Variants outside the CDS, not matching the reference, or involving
+        bases other than ACGT are not synonymous.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        refs = ''.join(refs)
+        alts = ''.join(alts)
+        assert len(refs) == len(alts) == len(positions), \
+            "Expected one ref and alt base per position"
+        try:
+            mrna = self.cds()
+        except AssertionError:
+            return np.zeros(len(positions), dtype=bool)
+
+        # Make nucs tx strand
+        if self._strand == '-':
+            refs = refs.translate(COMPLEMENT_TAB)
+            alts = alts.translate(COMPLEMENT_TAB)
+        ref_codes = NUC_CODE[np.frombuffer(refs, dtype=np.uint8)]
+        alt_codes = NUC_CODE[np.frombuffer(alts, dtype=np.uint8)]
+        mrna_codes = NUC_CODE[np.frombuffer(mrna, dtype=np.uint8)]
+
+        offsets = self.project_to_cds_array(positions)
+        in_cds = offsets >= 0
+        offsets[~in_cds] = 0
+        frames = offsets % 3
+        codon_starts = offsets - frames
+        codons = mrna_codes[codon_starts[:, np.newaxis] + np.arange(3)]
+        new_codons = codons.copy()
+        new_codons[np.arange(len(offsets)), frames] = alt_codes
+
+        valid = in_cds & (ref_codes >= 0) & (alt_codes >= 0) & \
+            (mrna_codes[offsets] == ref_codes) & (codons >= 0).all(axis=1)
+        weights = np.array([16, 4, 1])
+        old_aas = CODON_AA[np.dot(np.maximum(codons, 0), weights)]
+        new_aas = CODON_AA[np.dot(np.maximum(new_codons, 0), weights)]
+        return valid & (old_aas == new_aas)
+
 def iter_ucsc_genes(filename):
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
@@ -347,23 +601,156 @@ def iter_ucsc_genes(filename):
                    'tx': name}
 
 
+class StoredGenes(object):
+    """Read-only dict: gene_name -> set(genes), backed by a GeneStore
+
+    A gene's transcripts are created the first time it is looked up, and
+    each reads its sequence from the store the first time it is needed
+    (bounded by seq_cache, if given).
+    """
+    def __init__(self, store, seq_cache=None):
+        self._store = store
+        self._seq_cache = seq_cache
+        self._genes = {}
+        self._rows = {}  # row -> Transcript
+
+    def _seq_source(self, row, seq_offset):
+        store = self._store
+        return lambda: (store.seq(row), seq_offset)
+
+    def __getitem__(self, gene):
+        txs = self._genes.get(gene)
+        if txs is None:
+            rows = self._store.rows(gene)
+            if not rows:
+                raise KeyError(gene)
+
+            txs = set()
+            for row, record in zip(rows, self._store.records(rows)):
+                del record['seq_offset']
+                seq_source = self._seq_source(row, record['tx_start'])
+                tx = Transcript(seq_source=seq_source,
+                                seq_cache=self._seq_cache, **record)
+                self._rows[row] = tx
+                txs.add(tx)
+
+            self._genes[gene] = txs
+
+        return txs
+
+    def get(self, gene, default=None):
+        try:
+            return self[gene]
+        except KeyError:
+            return default
+
+    def transcript(self, row):
+        """Return the Transcript of a row of the store"""
+        tx = self._rows.get(row)
+        if tx is None:
+            self[str(self._store.columns['gene'][row])]
+            tx = self._rows[row]
+        return tx
+
+    def transcripts_by_accession(self, tx_id):
+        """Return the list of Transcripts with accession tx_id"""
+        return [self.transcript(row) for row in self._store.tx_rows(tx_id)]
+
+    def cds_index(self):
+        """Return the store's IntervalIndex of CDS, with rows as ids"""
+        return self._store.cds_index
+
+    def __contains__(self, gene):
+        return gene in self._store
+
+    def __len__(self):
+        return len(self._store.gene_names())
+
+    def __iter__(self):
+        return iter(self._store.gene_names())
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return self._store.gene_names()
+
+    def iteritems(self):
+        for gene in self:
+            yield gene, self[gene]
+
+def is_pickle(filename):
+    return filename.endswith('.pkl') or filename.endswith('.pkl.gz')
+
+def genome_seq_source(chrom_seq):
+    return lambda: (chrom_seq, 0)
+
+def iter_loci(entries):
+    """Group gene entries into loci of overlapping transcripts
+    yields (start, end, entries), sorted by start
+    """
+    entries = sorted(entries, key=lambda entry: int(entry['tx_start']))
+    locus = []
+    for entry in entries:
+        if locus and int(entry['tx_start']) >= end:
+            yield start, end, locus
+            locus = []
+        if not locus:
+            start = int(entry['tx_start'])
+            end = int(entry['tx_end'])
+        end = max(end, int(entry['tx_end']))
+        locus.append(entry)
+    if locus:
+        yield start, end, locus
+
 def get_genes(gene_filename=None, cache_filename=None,
-              genome_filename=None, **kwargs):
+              genome_filename=None, lazy_seq=False, max_seqs=None, **kwargs):
     """Loads (potentially cached) dict: gene_name -> set(genes)
 
     If not cached, genome_filename FASTA expected to provide sequence data
+    cache_filename is a pickled file if it ends with .pkl or .pkl.gz,
+    and otherwise a gene store directory (see silva.genestore)
+    Transcripts share the sequence of their locus (see SeqSpan), from
+    which their pre-mRNA and mRNA are sliced when first needed
+    If lazy_seq, and genes are not cached, transcripts are created with
+    coordinates only, and read their sequence from the genome instead
+    (transcripts from a gene store always read from the store)
+    If max_seqs, at most max_seqs transcripts keep sliced sequence at once
     """
     assert gene_filename and genome_filename or cache_filename
-    if cache_filename is not None and os.path.isfile(cache_filename):
+    seq_cache = SeqCache(max_seqs) if max_seqs else None
+    if cache_filename is not None and is_pickle(cache_filename):
+        cache_exists = os.path.isfile(cache_filename)
+    else:
+        cache_exists = cache_filename is not None and \
+            is_gene_store(cache_filename)
+
+    if cache_exists and is_pickle(cache_filename):
         print >>sys.stderr, "Loading genes from pickled file: %s" % cache_filename
         with maybe_gzip_open(cache_filename) as ifp:
             genes = cPickle.load(ifp)
+        for txs in genes.itervalues():
+            for tx in txs:
+                tx._seq_cache = seq_cache
+    elif cache_exists:
+        print >>sys.stderr, "Loading genes from gene store: %s" % cache_filename
+        genes = StoredGenes(GeneStore(cache_filename), seq_cache=seq_cache)
     else:
-        genome = Genome(genome_filename)
+        genome = Genome(genome_filename, use_mmap=True)
+        if cache_filename and not is_pickle(cache_filename):
+            store_writer = GeneStoreWriter(cache_filename)
+        else:
+            store_writer = None
+
+        # Caches are written with sequence
+        lazy_seq = lazy_seq and not cache_filename
 
         genes = defaultdict(set)
         missed_chroms = set()
         n_zero_len = 0
+        # Group entries by chromosome, so that each chromosome's transcript
+        # sequences can be fetched together, with overlapping isoforms read
+        # only once (see TwoBitFile.get_regions)
+        chrom_entries = defaultdict(list)
         for entry in iter_ucsc_genes(gene_filename):
             chrom = entry['chrom']
             if not chrom.startswith('chr'):
@@ -377,20 +764,56 @@ def get_genes(gene_filename=None, cache_filename=None,
                 
                 continue
 
-            # Substitute id with gene name
-            entry['seq'] = genome[chrom]
-            try:
-                t = Transcript(**entry)
-            except AssertionError, e:
-                if "Zero-length CDS" in str(e):
-                    n_zero_len += 1
-                else:
-                    print >>sys.stderr, "Skipping transcript: %s: %s" \
-                        % (entry['gene'], e)
-                continue
+            chrom_entries[chrom].append(entry)
+
+        n_loci = n_span_bases = n_tx_bases = 0
+        for chrom, entries in chrom_entries.iteritems():
+            if lazy_seq:
+                loci = [(genome_seq_source(genome[chrom]), entries)]
+            else:
+                # Each locus is read once, and shared by its transcripts
+                loci = list(iter_loci(entries))
+                regions = [(chrom, start, end) for start, end, _ in loci]
+                seqs = genome.get_regions(regions)
+                loci = [(SeqSpan(seq, start), locus_entries) for
+                        seq, (start, end, locus_entries) in zip(seqs, loci)]
+
+            for seq_source, locus_entries in loci:
+                n_valid = 0
+                for entry in locus_entries:
+                    entry['seq_source'] = seq_source
+                    entry['seq_cache'] = seq_cache
+                    try:
+                        t = Transcript(**entry)
+                        t.check_stop_codon(*seq_source())
+                    except AssertionError, e:
+                        if "Zero-length CDS" in str(e):
+                            n_zero_len += 1
+                        else:
+                            print >>sys.stderr, "Skipping transcript: %s: %s" \
+                                % (entry['gene'], e)
+                        continue
 
-            if t.valid():
-                genes[entry['gene']].add(t)
+                    if t.valid():
+                        genes[entry['gene']].add(t)
+                        n_tx_bases += len(t)
+                        if store_writer is not None:
+                            if not n_valid:
+                                store_writer.add_span(entry['chrom'],
+                                                      seq_source.start,
+                                                      seq_source.seq)
+                            store_writer.add(entry)
+                        n_valid += 1
+
+                if n_valid and not lazy_seq:
+                    n_loci += 1
+                    n_span_bases += len(seq_source)
+
+        if n_loci:
+            print >>sys.stderr, "Stored pre-mRNA sequence as %d loci: %d bp" \
+                " instead of %d bp (%.1f%% saved)" % \
+                (n_loci, n_span_bases, n_tx_bases,
+                 100 * (1 - n_span_bases / n_tx_bases))
 
         if n_zero_len:
             print >>sys.stderr, "Skipped %d transcripts with zero-length CDS" \
@@ -401,30 +824,64 @@ def get_genes(gene_filename=None, cache_filename=None,
                 % ', '.join(sorted(missed_chroms))
             
         genes = dict(genes)  # remove defaultdict
-        if cache_filename:
+        if store_writer is not None:
+            print >>sys.stderr, "Saving genes to gene store: %s" % cache_filename
+            store_writer.close()
+            genes = StoredGenes(GeneStore(cache_filename), seq_cache=seq_cache)
+        elif cache_filename:
             print >>sys.stderr, "Saving genes to pickled file: %s" % cache_filename
             with open(cache_filename, 'wb') as ofp:
                 cPickle.dump(genes, ofp, cPickle.HIGHEST_PROTOCOL)
 
     return genes
 
-def get_transcript_from_protein(genes, gene, aa_pos, aa, mutation, *args, **kwargs):
+class ProteinIndex(object):
+    """(gene, aa_pos) -> list of (codon, tx, positions) for each of gene's
+    transcripts with a codon at aa_pos (1-indexed), positions being the
+    genome positions (1-indexed) of the codon's bases
+
+    Entries are computed the first time they are looked up.
+    """
+    def __init__(self, genes):
+        self._genes = genes
+        self._codons = {}
+
+    def get(self, gene, aa_pos):
+        key = (gene, aa_pos)
+        codons = self._codons.get(key)
+        if codons is None:
+            codons = []
+            if aa_pos >= 1:
+                for tx in self._genes.get(gene, []):
+                    codon = tx.get_codon(aa_pos)
+                    if not codon: continue
+                    start = (aa_pos - 1) * 3
+                    positions = [tx.project_from_cds(offset) for offset in
+                                 xrange(start, start + len(codon))]
+                    codons.append((codon, tx, positions))
+            self._codons[key] = codons
+
+        return codons
+
+def get_transcript_from_protein(genes, gene, aa_pos, aa, mutation,
+                                protein_index=None, *args, **kwargs):
     """Find longest transcripts matching protein coordinates
 
     gene: gene name (e.g. 'ABCB1')
     aa_pos: amino acid position (e.g. 1145), 1-indexed
     aa: amino acid code (e.g. 'I')
     mutation: nucleotide from, to (e.g. 'C>T')
+    protein_index: ProteinIndex of genes, reused across calls
 
     returns (tx, chrom, pos, ref, alt)
     """
     aa_pos = int(aa_pos)
-    txs = genes.get(gene, [])
+    if protein_index is None:
+        protein_index = ProteinIndex(genes)
+    nuc_from, nuc_to = mutation.split('>')
     matches = []
-    for tx in txs:
-        codon = tx.get_codon(aa_pos)
-        nuc_from, nuc_to = mutation.split('>')
-        if not codon or AA_CODE[codon] != aa: continue
+    for codon, tx, positions in protein_index.get(gene, aa_pos):
+        if AA_CODE[codon] != aa: continue
         
         # Verify synonymous mutation is unambiguous
         frame = None
@@ -440,29 +897,50 @@ def get_transcript_from_protein(genes, gene, aa_pos, aa, mutation, *args, **kwar
         if frame is not None: # unambiguous match
             ref = nuc_from if tx.strand() == '+' else COMPLEMENT[nuc_from]
             alt = nuc_to if tx.strand() == '+' else COMPLEMENT[nuc_to]
-            cds_offset = (aa_pos - 1) * 3 + frame
-            pos = tx.project_from_cds(cds_offset)
-            matches.append((tx, tx.chrom(), pos, ref, alt))
+            matches.append((tx, tx.chrom(), positions[frame], ref, alt))
             
     if matches:
         return max(matches)  # longest transcript
     else:
+        txs = genes.get(gene, [])
         print >>sys.stderr, "No match found for %s, %s, %s, %s" % (gene, aa_pos, aa, mutation)
         print >>sys.stderr, "Found %d transcripts" % len(txs)
         for tx in txs:
             codon = tx.get_codon(aa_pos)
-            nuc_from, nuc_to = mutation.split('>')
             print >>sys.stderr, "%s: codon: %s -> %s" % (tx.tx(), codon, AA_CODE.get(codon, ''))
 
 
-def get_transcript(genes, pos, ref, alt, gene_id, tx_id):
-    try:
-        txs = genes[gene_id]
-    except KeyError:
+def get_accession_index(genes):
+    """Return a function returning the list of transcripts with a given
+    accession (maybe several, e.g. on different chromosomes)
+
+    Lookups go through the gene store, or else through a dict built here
+    """
+    if isinstance(genes, StoredGenes):
+        return genes.transcripts_by_accession
+
+    index = defaultdict(list)
+    for txs in genes.itervalues():
+        for tx in txs:
+            index[tx.tx()].append(tx)
+    return lambda tx_id: index.get(tx_id, [])
+
+def get_transcript(genes, pos, ref, alt, gene_id, tx_id, find_accession=None):
+    """Return gene_id's transcript with accession tx_id in which the
+    mutation is synonymous, or None (with a message why)
+
+    find_accession: function returning the transcripts with an accession
+      (see get_accession_index), otherwise all of gene's transcripts are
+      searched
+    """
+    if gene_id not in genes:
         print >>sys.stderr, "Missing entry for gene: %s" % gene_id
         return
 
-    txs = [x for x in txs if x.tx() == tx_id]
+    if find_accession is None:
+        txs = [x for x in genes[gene_id] if x.tx() == tx_id]
+    else:
+        txs = [x for x in find_accession(tx_id) if x.gene() == gene_id]
     if len(txs) == 0:
         print >>sys.stderr, "Missing entry for transcript: %s" % tx_id
         return
@@ -481,60 +959,108 @@ def get_transcript(genes, pos, ref, alt, gene_id, tx_id):
               "synonymous among copies of %s" % (pos, ref, alt, tx_id)
         return
 
-def random_synonymous_site(tx, cpg=None, avoid_splice=False):
+class SynonymousSites(object):
+    """Table of every synonymous site of a transcript: cds offset, ref and
+    alt (mRNA strand), whether the mutation creates or destroys a CpG, and
+    the distance (in the mRNA) to the nearest splice site
+
+    Sites can be drawn from strata by CpG status and distance to a splice
+    site; the rows of each stratum are computed once and kept.
+    """
+    def __init__(self, tx):
+        mrna = tx.cds()
+        bases = np.frombuffer(mrna, dtype=np.uint8)
+        n_codons = len(mrna) // 3
+        codons = NUC_CODE[bases[:3 * n_codons]].reshape(n_codons, 3)
+        codon_codes = np.dot(np.maximum(codons, 0), [16, 4, 1])
+        mask = SYN_MUTATION_MASK[codon_codes]
+        mask[~(codons >= 0).all(axis=1)] = False
+        codon_index, frames, alt_codes = np.nonzero(mask)
+        offsets = 3 * codon_index + frames
+        refs = bases[offsets]
+        alts = np.frombuffer('ACGT', dtype=np.uint8)[alt_codes]
+
+        C, G = ord('C'), ord('G')
+        padded = np.concatenate(([0], bases, [0]))
+        pre = padded[offsets]
+        post = padded[offsets + 2]
+        self.cpg = ((pre == C) & ((refs == G) | (alts == G))) | \
+            ((post == G) & ((refs == C) | (alts == C)))
+
+        # Splice sites: the mRNA offset where each CDS interval starts
+        lengths = [end - start for start, end in tx._cds]
+        if tx.strand() == '-':
+            lengths.reverse()
+        splice_sites = np.cumsum([0] + lengths[:-1])
+        assert sum(lengths) == len(mrna)
+        i = np.searchsorted(splice_sites, offsets)
+        before = splice_sites[np.maximum(i - 1, 0)]
+        after = splice_sites[np.minimum(i, len(splice_sites) - 1)]
+        self.splice_dist = np.minimum(np.abs(offsets - before),
+                                      np.abs(offsets - after))
+
+        self.offsets = offsets
+        self.refs = refs
+        self.alts = alts
+        self._strata = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def site(self, i):
+        """Return the i-th site: (cds offset, ref, alt)"""
+        return int(self.offsets[i]), chr(self.refs[i]), chr(self.alts[i])
+
+    def stratum(self, cpg=None, avoid_splice=False):
+        """Return the array of rows of the sites with the given CpG status
+        (if not None), and, if avoid_splice, more than 3 bp from a splice site
+        """
+        key = (cpg, avoid_splice)
+        rows = self._strata.get(key)
+        if rows is None:
+            mask = np.ones(len(self), dtype=bool)
+            if cpg is not None:
+                mask &= self.cpg == cpg
+            if avoid_splice:
+                mask &= self.splice_dist > 3
+            rows = self._strata[key] = np.flatnonzero(mask)
+        return rows
+
+def random_synonymous_site(tx, cpg=None, avoid_splice=False, sites=None,
+                           rand=None):
     """Return random synonymous site (cds offset, ref, alt)
     cpg: if True or False, returned site is matched to this
     avoid_splice: if True, no mutations within 3 bp of splice site will be chosen
+    sites: SynonymousSites of tx, if already computed
+    rand: random.Random to draw from (e.g. seeded)
     """
-    splice_sites = []
-    cum_sum = 0
-    cds_intervals = reversed(tx._cds) if tx._strand == '-' else tx._cds
-    for start, end in cds_intervals:
-        splice_sites.append(cum_sum)
-        cum_sum += (end - start)
-        
-    assert cum_sum == len(tx._mrna)
-
-    matched_sites = set()
-    syn_sites = set()
-    for codon_offset in xrange(0, len(tx._mrna), 3):
-        codon = tx._mrna[codon_offset:codon_offset + 3]
-        for frame, alt in SYN_MUTATIONS[codon]:
-            offset = codon_offset + frame
-            ref = codon[frame]
-            pre = tx._mrna[max(offset - 1, 0):offset]
-            post = tx._mrna[offset + 1:offset + 2]
-            has_cpg = bool((pre and pre[0] == 'C' and 
-                            (ref == 'G' or alt == 'G')) or 
-                           (post and post[0] == 'G' and 
-                            (ref == 'C' or alt == 'C')))
-            splice_dist = min([abs(s - offset) for s in splice_sites])
-            syn_sites.add((offset, ref, alt))
-            if cpg is None or cpg == has_cpg:
-                if not avoid_splice or splice_dist > 3:
-                    matched_sites.add((offset, ref, alt))
-
-    if matched_sites:
-        sites = matched_sites
-    else:
-        sites = syn_sites
+    if sites is None:
+        sites = SynonymousSites(tx)
+    rows = sites.stratum(cpg, avoid_splice)
+    if not len(rows):
+        rows = sites.stratum()
         print >>sys.stderr, "Warning: no matched synonymous mutation possible"
 
-    return sample(sites, 1)[0]
+    draw = rand.randrange if rand is not None else randrange
+    return sites.site(rows[draw(len(rows))])
 
-def random_controls(genes, filename, match_cpg=False, avoid_splice=False):
+# Synonymous site tables are kept for this many recently used transcripts
+SITE_CACHE_SIZE = 1000
+
+def random_controls(genes, filename, match_cpg=False, avoid_splice=False,
+                    seed=None):
     fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
+    find_accession = get_accession_index(genes)
+    rand = Random(seed)
+    site_cache = OrderedDict()  # tx -> SynonymousSites, least recent first
     print '#%s' % '\t'.join(fields)
     with maybe_gzip_open(filename) as ifp:
-        for line in ifp:
-            line = line.rstrip()
-            if not line or line.startswith('#'): continue
-
-            tokens = line.split()
-            chrom, pos, id, ref, alt, gene_id, tx_id = tokens[:7]
+        for fields, rest in iter_records(ifp, 7):
+            chrom, pos, id, ref, alt, gene_id, tx_id = fields
             chrom = chrom[3:] if chrom.startswith('chr') else chrom
             pos = int(pos)
-            tx = get_transcript(genes, pos, ref, alt, gene_id, tx_id)
+            tx = get_transcript(genes, pos, ref, alt, gene_id, tx_id,
+                                find_accession)
             if not tx:
                 continue
 
@@ -555,77 +1081,200 @@ def random_controls(genes, filename, match_cpg=False, avoid_splice=False):
             else:
                 cpg=None
 
+            sites = site_cache.pop(tx, None)
+            if sites is None:
+                sites = SynonymousSites(tx)
+                if len(site_cache) >= SITE_CACHE_SIZE:
+                    site_cache.popitem(last=False)
+            site_cache[tx] = sites
+
             cds_offset, new_ref, new_alt = \
-                random_synonymous_site(tx, cpg=cpg, avoid_splice=avoid_splice)
+                random_synonymous_site(tx, cpg=cpg, avoid_splice=avoid_splice,
+                                       sites=sites, rand=rand)
             new_pos = tx.project_from_cds(cds_offset)
             if tx.strand() == '-':
                 new_ref = COMPLEMENT[new_ref]
                 new_alt = COMPLEMENT[new_alt]
 
-            print '\t'.join([chrom, str(new_pos), id, new_ref, new_alt, 
-                             gene_id, tx.tx()] + tokens[7:])
+            print join_fields([chrom, str(new_pos), id, new_ref, new_alt,
+                               gene_id, tx.tx()], rest)
 
-def print_all_synonymous(genes):
-    fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
-    print '#%s' % '\t'.join(fields)
-    
+def synonymous_sites(tx):
+    """Return all synonymous sites of tx as (positions, refs, alts): an
+    array of genome positions (1-indexed), and strings of the ref and alt
+    base (+ strand) of each site
+    """
+    sites = SynonymousSites(tx)
+    positions = tx.project_from_cds_array(sites.offsets)
+    refs = sites.refs.tostring()
+    alts = sites.alts.tostring()
+    if tx.strand() == '-':
+        refs = refs.translate(COMPLEMENT_TAB)
+        alts = alts.translate(COMPLEMENT_TAB)
+    return positions, refs, alts
+
+def format_synonymous(chrom, chrom_id, first_tx_id, gene_txs, output_format):
+    """Return the synonymous sites of the transcripts of one chromosome,
+    sorted by position (then transcript), as a string in output_format:
+    text lines, BGZF blocks of the same ('bgzip'), or site table records
+    ('binary', see silva.sitetable)
+
+    gene_txs: list of (gene, tx), the i-th tx having id first_tx_id + i
+    """
+    positions, refs, alts, tx_ids = [], [], [], []
+    for i, (gene, tx) in enumerate(gene_txs):
+        tx_positions, tx_refs, tx_alts = synonymous_sites(tx)
+        positions.append(tx_positions)
+        refs.append(tx_refs)
+        alts.append(tx_alts)
+        tx_ids.append(np.repeat(i, len(tx_positions)))
+    positions = np.concatenate(positions or [np.zeros(0, dtype=int)])
+    tx_ids = np.concatenate(tx_ids or [np.zeros(0, dtype=int)])
+
+    # Sites of - strand and overlapping transcripts are out of order, and
+    # bgzip output must be sorted to be indexed by tabix
+    order = np.lexsort((tx_ids, positions))
+    positions = positions[order]
+    tx_ids = tx_ids[order]
+    refs = np.frombuffer(''.join(refs), dtype='S1')[order].tostring()
+    alts = np.frombuffer(''.join(alts), dtype='S1')[order].tostring()
+
+    if output_format == 'binary':
+        return encode_sites(chrom_id, positions, refs, alts,
+                            first_tx_id + tx_ids)
+
+    suffixes = ['\t%s\t%s\n' % (gene, tx.tx()) for gene, tx in gene_txs]
+    data = ''.join(['%s\t%d\t.\t%s\t%s%s' % (chrom, pos, ref, alt, suffixes[i])
+                    for pos, ref, alt, i in zip(positions.tolist(), refs, alts,
+                                                tx_ids.tolist())])
+    if output_format == 'bgzip':
+        data = bgzf.compress(data)
+    return data
+
+# Set in the parent process before forking generate --all workers
+_synonymous_shards = None
+
+def _format_shard(i):
+    return format_synonymous(*_synonymous_shards[i])
+
+def print_all_synonymous(genes, output_format='text', jobs=1):
+    """Print every synonymous site of the longest transcript of each gene,
+    sorted by chromosome and position, in output_format (see
+    format_synonymous)
+
+    If jobs > 1, chromosomes are formatted by that many forked processes.
+    """
+    global _synonymous_shards
+    chrom_txs = defaultdict(list)
     for gene, txs in genes.iteritems():
         tx = max(txs)
-        for offset in xrange(0, len(tx._mrna), 3):
-            codon = tx._mrna[offset:offset + 3]
-            for frame, alt in SYN_MUTATIONS[codon]:
-                ref = codon[frame]
-                if tx.strand() == '-':
-                    ref = COMPLEMENT[ref]
-                    alt = COMPLEMENT[alt]
+        chrom_txs[tx.chrom()].append((gene, tx))
+
+    chroms = sorted(chrom_txs)
+    shards = []
+    all_gene_txs = []
+    for chrom_id, chrom in enumerate(chroms):
+        gene_txs = sorted(chrom_txs[chrom],
+                          key=lambda (gene, tx): (tx._tx_start, gene))
+        shards.append((chrom, chrom_id, len(all_gene_txs), gene_txs,
+                       output_format))
+        all_gene_txs.extend(gene_txs)
+
+    out = sys.stdout
+    header = '#%s\n' % '\t'.join(['chrom', 'pos', 'id', 'ref', 'alt', 'gene',
+                                  'tx'])
+    if output_format == 'binary':
+        write_header(out, chroms, [gene for gene, tx in all_gene_txs],
+                     [tx.tx() for gene, tx in all_gene_txs])
+    elif output_format == 'bgzip':
+        out = bgzf.BgzfWriter(sys.stdout)
+        out.write(header)
+        out.flush()
+    else:
+        out.write(header)
 
-                pos = tx.project_from_cds(offset+frame)
-                print '\t'.join([tx.chrom(), str(pos), '.', ref, alt, 
-                                 gene, tx.tx()])
+    _synonymous_shards = shards
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(_format_shard, xrange(len(shards)))
+    else:
+        pool = None
+        results = (_format_shard(i) for i in xrange(len(shards)))
 
-def filter_variants(genes, filename, protein_coords=False):
-    # Do chromosomal binning to efficiently lookup overlapping transcripts
-    n_bins = 2048
-    tx_locations = defaultdict(lambda: defaultdict(list))
-    for gene, txs in genes.iteritems():
-        for tx in txs:
-            assert tx.gene() == gene
-            start = tx._cds_start + 1
-            end = tx._cds_end
-            i = int(start / n_bins)
-            j = int(end / n_bins)
-            for bin in xrange(i, j+1):
-                tx_locations[tx.chrom()][bin].append((start, end, tx))
+    for data in results:
+        if output_format == 'bgzip':
+            out.write_blocks(data)
+        else:
+            out.write(data)
+
+    if output_format == 'bgzip':
+        out.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    _synonymous_shards = None
+
+def get_cds_index(genes):
+    """Return (IntervalIndex of the CDS of genes' transcripts, function
+    returning the Transcript with a given id)
+
+    The index is loaded from a gene store, or else built
+    """
+    if isinstance(genes, StoredGenes):
+        return genes.cds_index(), genes.transcript
+
+    all_txs = [tx for txs in genes.itervalues() for tx in txs]
+    index = IntervalIndex.build([tx.chrom() for tx in all_txs],
+                                [tx._cds_start for tx in all_txs],
+                                [tx._cds_end for tx in all_txs])
+    return index, all_txs.__getitem__
+
+# Variants are classified in batches of this many lines
+FILTER_BATCH_SIZE = 10000
+
+def iter_filtered(genes, lines, cds_index, get_tx, protein_coords=False,
+                  sorted_input=False, counts=None):
+    """Yield the output line of each synonymous variant in lines
+    counts, if given, is a dict in which 'total', 'kept' and 'unsorted'
+    are updated
+    """
+    if counts is None:
+        counts = {}
+    for key in ['total', 'kept', 'unsorted']:
+        counts.setdefault(key, 0)
+
+    if sorted_input:
+        # Walk the CDS alongside the variants
+        cds_finder = IntervalSweep(cds_index)
+    else:
+        cds_finder = cds_index
 
     def find_overlapping_transcripts(chrom, pos):
-        bin = int(pos / n_bins)
-        txs = tx_locations[chrom][bin]
-        return [tx for (start, end, tx) in txs if start <= pos <= end]
+        return [get_tx(id) for id in cds_finder.query(chrom, pos - 1)]
+
+    if protein_coords:
+        protein_index = ProteinIndex(genes)
             
-    fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
-    print '#%s' % '\t'.join(fields)
-    n_total = 0
-    n_kept = 0
-    with maybe_gzip_open(filename) as ifp:
-        for line in ifp:
-            line = line.rstrip()
-            if not line or line.startswith('#'): continue
-            n_total += 1
+    for batch in iter_chunks(lines, FILTER_BATCH_SIZE):
+        # Parse the batch, then classify its SNVs a transcript at a time
+        records = []
+        snvs = []
+        for line in batch:
+            if not line.strip() or line.startswith('#'): continue
+            counts['total'] += 1
 
-            tokens = line.split()
             if protein_coords:
-                gene, codon, aa, mut = tokens[:4]
-                rest = tokens[1:]
+                fields, rest = split_fields(line, 4)
+                gene, codon, aa, mut = fields
+                rest = join_fields(fields[1:], rest)
                 match = get_transcript_from_protein(genes, gene, codon, 
-                                                    aa, mut)
-                if match is None:
-                    tx = None
-                else:
+                                                    aa, mut, protein_index)
+                if match is not None:
                     (tx, chrom, pos, ref, alt) = match
-                    id = '.'
+                    records.append([chrom, pos, '.', ref, alt, rest, [tx]])
             else:
-                chrom, pos, id, ref, alts = tokens[:5]
-                rest = tokens[5:]
+                fields, rest = split_fields(line, 5)
+                chrom, pos, id, ref, alts = fields
                 chrom = chrom[3:] if chrom.startswith('chr') else chrom
                 alt = alts.split(',')[0]
                 # Only process SNVs
@@ -633,72 +1282,305 @@ def filter_variants(genes, filename, protein_coords=False):
                     continue
 
                 pos = int(pos)
-                txs = []
-                for tx in find_overlapping_transcripts(chrom, pos):
-                    try:
-                        if tx.is_synonymous(pos, ref, alt):
-                            txs.append(tx)
-                    except AssertionError:
-                        continue
-
-                tx = max(txs) if txs else None  # Take longest valid transcript
-
-            if not tx:
+                record = [chrom, pos, id, ref, alt, rest, []]
+                records.append(record)
+                snvs.append((record, find_overlapping_transcripts(chrom, pos)))
+
+        for tx, tx_records in group_by_transcript(snvs).iteritems():
+            mask = tx.is_synonymous_array([record[1] for record in tx_records],
+                                          [record[3] for record in tx_records],
+                                          [record[4] for record in tx_records])
+            for record, synonymous in zip(tx_records, mask):
+                if synonymous:
+                    record[-1].append(tx)
+
+        for chrom, pos, id, ref, alt, rest, txs in records:
+            if not txs:
                 continue
 
-            n_kept += 1
-            print '\t'.join([chrom, str(pos), id, ref, alt, tx.gene(), tx.tx()] + rest)
+            tx = max(txs)  # Take longest valid transcript
+            counts['kept'] += 1
+            yield join_fields([chrom, str(pos), id, ref, alt, tx.gene(),
+                               tx.tx()], rest)
 
-        print >>sys.stderr, "Found %d synonymous variants (%d dropped)" % \
-              (n_kept, n_total - n_kept)
+    if sorted_input and not cds_finder.sorted:
+        counts['unsorted'] += 1
 
-def annotate_variants(genes, filename):
-    fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx', 'strand',
-              'codon', 'frame', 'premrna']
-    print '#%s' % '\t'.join(fields)
-    with maybe_gzip_open(filename) as ifp:
-        for line in ifp:
-            line = line.rstrip()
-            if not line or line.startswith('#'): continue
-
-            tokens = line.split()
-            chrom, pos, id, ref, alt, gene_id, tx_id = tokens[:7]
-            chrom = chrom[3:] if chrom.startswith('chr') else chrom
-            pos = int(pos)
-
-            tx = get_transcript(genes, pos, ref, alt, gene_id, tx_id)
-            if not tx:
-                continue
+def group_by_transcript(variants):
+    """Given (variant, transcripts) pairs, return a dict:
+    transcript -> list of its variants
+    """
+    tx_variants = defaultdict(list)
+    for variant, txs in variants:
+        for tx in txs:
+            tx_variants[tx].append(variant)
+    return tx_variants
+
+# Set in the parent process before forking filter workers, so that they
+# share the gene models instead of receiving them pickled
+_filter_args = None
+
+def _filter_chunk(lines):
+    genes, cds_index, get_tx, protein_coords, sorted_input = _filter_args
+    counts = {}
+    out_lines = list(iter_filtered(genes, lines, cds_index, get_tx,
+                                   protein_coords=protein_coords,
+                                   sorted_input=sorted_input, counts=counts))
+    return out_lines, counts
+
+def iter_chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_synonymous(genes, lines, protein_coords=False, sorted_input=False,
+                    jobs=1, chunk_size=10000, counts=None):
+    """Yield the output line of each synonymous variant in lines, in order
+    (see iter_filtered)
+
+    If jobs > 1, chunks of chunk_size lines are filtered by that many
+    forked processes
+    """
+    global _filter_args
+    # Index CDS to efficiently lookup overlapping transcripts
+    cds_index, get_tx = get_cds_index(genes)
+    if counts is None:
+        counts = defaultdict(int)
+
+    if jobs > 1:
+        _filter_args = (genes, cds_index, get_tx, protein_coords,
+                        sorted_input)
+        pool = Pool(jobs)
+
+        def chunk_lines(result):
+            out_lines, chunk_counts = result.get()
+            for key, value in chunk_counts.iteritems():
+                counts[key] = counts.get(key, 0) + value
+            return out_lines
 
-            # Get codon, frame, and mrna
-            cds_offset = tx.project_to_cds(pos)
-            aa_pos = int(cds_offset / 3) + 1
-            codon = tx.get_codon(aa_pos)
-            frame = cds_offset % 3
+        try:
+            # Keep a few chunks per process queued, yielding them in order
+            pending = deque()
+            for chunk in iter_chunks(lines, chunk_size):
+                pending.append(pool.apply_async(_filter_chunk, (chunk,)))
+                if len(pending) >= 2 * jobs:
+                    for line in chunk_lines(pending.popleft()):
+                        yield line
+            while pending:
+                for line in chunk_lines(pending.popleft()):
+                    yield line
+
+            pool.close()
+        finally:
+            # Also if the consumer raised or stopped early
+            pool.terminate()
+            pool.join()
+            _filter_args = None
+    else:
+        for line in iter_filtered(genes, lines, cds_index, get_tx,
+                                  protein_coords=protein_coords,
+                                  sorted_input=sorted_input,
+                                  counts=counts):
+            yield line
+
+def print_filter_counts(counts):
+    n_total = counts['total']
+    n_kept = counts['kept']
+    print >>sys.stderr, "Found %d synonymous variants (%d dropped)" % \
+          (n_kept, n_total - n_kept)
+    if counts['unsorted']:
+        print >>sys.stderr, "Warning: variants were not sorted by" \
+            " position, so were looked up in the CDS index instead"
+
+FILTER_FIELDS = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
+
+def filter_fields(payloads=None):
+    if payloads:
+        return FILTER_FIELDS + [PAYLOAD_FIELD]
+    return FILTER_FIELDS
+
+def keep_payload(payloads, line):
+    """Write the payload of the record of a filtered line, if stripped"""
+    if payloads:
+        payloads.keep(int(split_fields(line, len(FILTER_FIELDS))[1]))
+
+def filter_variants(genes, filename, protein_coords=False,
+                    sorted_input=False, jobs=1, chunk_size=10000,
+                    payload_filename=None):
+    """If jobs > 1, chunks of chunk_size lines are filtered by that many
+    forked processes, and printed in input order
+
+    payload_filename: write the payload of the variants to this side file
+    (see silva.payload)
+    """
+    payloads = None
+    if payload_filename:
+        assert not protein_coords, \
+            "Error: payload side files require VCF input"
+        payloads = PayloadWriter(payload_filename)
+
+    print '#%s' % '\t'.join(filter_fields(payloads))
+    counts = defaultdict(int)
+    with maybe_gzip_open(filename) as ifp:
+        lines = payloads.strip(ifp) if payloads else ifp
+        for line in iter_synonymous(genes, lines,
+                                    protein_coords=protein_coords,
+                                    sorted_input=sorted_input, jobs=jobs,
+                                    chunk_size=chunk_size, counts=counts):
+            keep_payload(payloads, line)
+            print line
+
+    if payloads:
+        payloads.close()
+
+    print_filter_counts(counts)
+
+def annotate_fields(full_context=False):
+    return FILTER_FIELDS + ['strand', 'codon', 'frame',
+                            'premrna' if full_context else 'context']
+
+def iter_annotated(genes, lines, full_context=False, find_accession=None):
+    """Yield the annotated line of each variant of lines (in the output
+    format of filter) that is synonymous in its transcript
+    """
+    if find_accession is None:
+        find_accession = get_accession_index(genes)
+    for fields, rest in iter_records(lines, 7):
+        chrom, pos, id, ref, alt, gene_id, tx_id = fields
+        chrom = chrom[3:] if chrom.startswith('chr') else chrom
+        pos = int(pos)
+
+        tx = get_transcript(genes, pos, ref, alt, gene_id, tx_id,
+                            find_accession)
+        if not tx:
+            continue
+
+        # Get codon, frame, and mrna
+        cds_offset = tx.project_to_cds(pos)
+        aa_pos = int(cds_offset / 3) + 1
+        codon = tx.get_codon(aa_pos)
+        frame = cds_offset % 3
 
+        if full_context:
             mut_str = tx.mutation_str(pos, ref, alt)
-            print '\t'.join([chrom, str(pos), id, ref, alt, tx.gene(), tx.tx(),
-                              tx.strand(), codon, str(frame), mut_str] + tokens[7:])
-
+        else:
+            mut_str = str(tx.mutation_context(pos, ref, alt))
+        yield join_fields([chrom, str(pos), id, ref, alt, tx.gene(), tx.tx(),
+                           tx.strand(), codon, str(frame), mut_str], rest)
 
+def annotate_variants(genes, filename, full_context=False):
+    """full_context: print the whole pre-mRNA instead of the compact
+    context of each variant (see silva.context)
+    """
+    print '#%s' % '\t'.join(annotate_fields(full_context))
+    with maybe_gzip_open(filename) as ifp:
+        for line in iter_annotated(genes, ifp, full_context=full_context):
+            print line
+
+def preprocess_variants(genes, filename, af_table, af_min=0.0, af_max=1.0,
+                        exclude_chroms=[], syn_filename=None,
+                        af_filename=None, flt_filename=None,
+                        full_context=False, sorted_input=False, jobs=1,
+                        payload_filename=None):
+    """Filter variants, look up their allele frequencies in af_table (see
+    silva.allelefreq), and annotate those in [af_min, af_max], in a single
+    pass, printing the annotated variants
+
+    Variants on exclude_chroms are dropped after filtering. The output of
+    each separate step (filter, 1000gp.py and the allele frequency filter)
+    is also written to syn_filename, af_filename and flt_filename, if given.
+    The payload of the filtered variants (all those in syn_filename, as by
+    filter_variants) is written to the side file payload_filename, if given
+    (see silva.payload).
+    """
+    outputs = {}
+    payloads = None
+    try:
+        for name, out_filename in [('syn', syn_filename), ('af', af_filename),
+                                   ('flt', flt_filename)]:
+            if out_filename:
+                outputs[name] = open(out_filename, 'w')
+        if payload_filename:
+            payloads = PayloadWriter(payload_filename)
+
+        def write(name, line):
+            if name in outputs:
+                print >>outputs[name], line
+
+        write('syn', '#%s' % '\t'.join(filter_fields(payloads)))
+        write('af', '#1000GP_AF')
+        write('flt', '#%s' % '\t'.join(filter_fields(payloads)))
+        print '#%s' % '\t'.join(annotate_fields(full_context))
+
+        def iter_kept(lines):
+            for line in lines:
+                chrom, pos, id, ref, alt = split_fields(line, 5)[0]
+                if chrom in exclude_chroms:
+                    continue
+                keep_payload(payloads, line)
+                write('syn', line)
+                af = format_af(af_table, chrom, pos, alt)
+                write('af', af)
+                if af_in_range(af, af_min, af_max):
+                    counts['af_kept'] += 1
+                    write('flt', line)
+                    yield line
+
+        counts = defaultdict(int)
+        with maybe_gzip_open(filename) as ifp:
+            lines = payloads.strip(ifp) if payloads else ifp
+            lines = iter_synonymous(genes, lines, sorted_input=sorted_input,
+                                    jobs=jobs, counts=counts)
+            for line in iter_annotated(genes, iter_kept(lines),
+                                       full_context=full_context):
+                print line
+    finally:
+        for ofp in outputs.itervalues():
+            ofp.close()
+        if payloads:
+            payloads.close()
+
+    print_filter_counts(counts)
+    print >>sys.stderr, "Left with %d variants with allele frequency in" \
+        " [%g, %g]" % (counts['af_kept'], af_min, af_max)
 
 def script(action, filename, protein_coords=False, genome_filename=None,
            all=False, random=False, match_cpg=False, avoid_splice=False,
-           **kwargs):
+           sorted_input=False, jobs=1, seed=None, output_format='text',
+           full_context=False, af_filename=None, af_cache=None, af_min=0.0,
+           af_max=1.0, exclude_chroms=[], syn_out=None, af_out=None,
+           flt_out=None, payload_filename=None, **kwargs):
     genes = get_genes(genome_filename=genome_filename, **kwargs)
 
     if action == 'generate':
         if random:
             random_controls(genes, filename, match_cpg=match_cpg, 
-                            avoid_splice=avoid_splice)
+                            avoid_splice=avoid_splice, seed=seed)
         elif all:
-            print_all_synonymous(genes)
+            print_all_synonymous(genes, output_format=output_format,
+                                 jobs=jobs)
         else:
             raise NotImplementedError()
     elif action == 'filter':
-        filter_variants(genes, filename, protein_coords=protein_coords)
+        filter_variants(genes, filename, protein_coords=protein_coords,
+                        sorted_input=sorted_input, jobs=jobs,
+                        payload_filename=payload_filename)
     elif action == 'annotate':
-        annotate_variants(genes, filename)
+        annotate_variants(genes, filename, full_context=full_context)
+    elif action == 'preprocess':
+        assert af_filename, "Preprocessing requires --af-table"
+        af_table = load_af_table(af_filename, af_cache)
+        preprocess_variants(genes, filename, af_table, af_min=af_min,
+                            af_max=af_max, exclude_chroms=exclude_chroms,
+                            syn_filename=syn_out, af_filename=af_out,
+                            flt_filename=flt_out, full_context=full_context,
+                            sorted_input=sorted_input, jobs=jobs,
+                            payload_filename=payload_filename)
     else:
         raise NotImplementedError()
 
@@ -715,7 +1597,7 @@ def run_tests():
                     [1, 11], [10, 23], 
                     seq=seq('CAAATGCCCTATTCCCCCCTAATCCCC'))
     #print t1
-    #print t1.__dict__
+    #print t1.__getstate__()
     assert t1.get_codon(1) == 'ATG'
     assert t1.get_codon(3) == 'TTT'
     assert t1.get_codon(6) == 'TAA'
@@ -753,11 +1635,23 @@ def run_tests():
                     seq=seq('AAATTAGGGGGGAATAGGGCATTCCCCCCC'))
     #                         uueeeeeeeeeeeieeeeeeeu
     print t1
-    print t1.__dict__
+    print t1.__getstate__()
     for i in range(20):
         site = random_synonymous_site(t1, cpg=None, avoid_splice=True)
         print site
 
+    # Site table matches the synonymous mutations of each codon
+    sites = SynonymousSites(t1)
+    mrna = t1.cds()
+    assert set(sites.site(i) for i in range(len(sites))) == \
+        set((offset + frame, mrna[offset + frame], alt)
+            for offset in range(0, len(mrna), 3)
+            for frame, alt in SYN_MUTATIONS[mrna[offset:offset + 3]])
+    assert (sites.splice_dist[sites.stratum(avoid_splice=True)] > 3).all()
+    assert [random_synonymous_site(t1, sites=sites, rand=Random(1))
+            for i in range(5)] == \
+        [random_synonymous_site(t1, rand=Random(1)) for i in range(5)]
+
     assert t1.get_codon(1) == 'ATG'
     assert t1.get_codon(3) == 'TTT'
     assert t1.get_codon(6) == 'TAA'
@@ -788,6 +1682,181 @@ def run_tests():
         r = t1.project_to_premrna(t1.project_from_premrna(i))
         assert r == i, "Inconsistent premrna translation for offset: %d" % i
 
+    # Batch projection matches the scalar projections
+    positions = range(2, 24)
+    offsets = [t1.project_to_cds(pos) if t1._cds_start < pos <= t1._cds_end
+               else None for pos in positions]
+    assert list(t1.project_to_cds_array(positions)) == \
+        [-1 if offset is None else offset for offset in offsets]
+    offsets = range(len(t1.cds()))
+    assert list(t1.project_from_cds_array(offsets)) == \
+        [t1.project_from_cds(offset) for offset in offsets]
+    assert list(t1.project_from_premrna_array(range(len(t1)))) == \
+        [t1.project_from_premrna(offset) for offset in range(len(t1))]
+    assert t1.mutation_str(14, 'A', 'G') == 'AATGCCCT|A|[T/C]TCCCCCCTAATT'
+    assert t1.mutation_str(15, 'T', 'G') == 'AATGCCCT|[A/C]|TTCCCCCCTAATT'
+
+    # Compact contexts agree with the full pre-mRNA, however little they keep
+    premrna = t1.premrna()
+    for pos in range(t1._tx_start + 1, t1._tx_end + 1):
+        ref = premrna[t1.project_to_premrna(pos)].translate(COMPLEMENT_TAB)
+        alt = 'A' if ref != 'A' else 'C'
+        full = MutationContext.parse(t1.mutation_str(pos, ref, alt))
+        for flank in [1, 2, 5, 100]:
+            offset, tx_ref, tx_alt = t1._mutation_offset(pos, ref, alt)
+            context = MutationContext.from_premrna(premrna, t1._edges, offset,
+                                                   tx_ref, tx_alt, flank)
+            assert MutationContext.parse(str(context)).__dict__ == \
+                context.__dict__
+            assert context.block() == full.block()
+            assert context.flanks(flank, flank) == full.flanks(flank, flank)
+            for name in ['premrna_lengths', 'mrna_lengths', 'block_lengths']:
+                assert getattr(context, name)() == getattr(full, name)()
+            start = context.mrna_start
+            assert context.mrna() == \
+                full.mrna()[start:start + len(context.mrna())]
+            assert context.mrna().count('/') == full.mrna().count('/')
+    assert str(t1.mutation_context(16, 'A', 'G')) == \
+        '@8,1,13;0;0;AATGCCC[T/C]ATTCCCCCCTAATT;0;AATGCCC[T/C]TTCCCCCCTAATT'
+
+
+    # Batch classification matches is_synonymous
+    variants = [(pos, ref, alt) for pos in range(1, 26)
+                for ref in 'ACGT' for alt in 'ACGT' if ref != alt]
+    mask = t1.is_synonymous_array(*zip(*variants))
+    for (pos, ref, alt), synonymous in zip(variants, mask):
+        try:
+            expected = t1.is_synonymous(pos, ref, alt)
+        except AssertionError:
+            expected = False
+        assert synonymous == expected, (pos, ref, alt)
+    assert mask.any()
+
+    # Lazily loaded sequence, bounded to one transcript
+    minus_seq = 'AAATTAGGGGGGAATAGGGCATTCCCCCCC'
+    seq_cache = SeqCache(1)
+    lazy = [Transcript('name1', 'tx1', 'chr1', 1, 23, '-', 3, 22,
+                       [1, 15], [14, 23], seq_cache=seq_cache,
+                       seq_source=lambda: (minus_seq, 0)) for i in range(2)]
+    lazy[0].check_stop_codon(minus_seq)
+    try:
+        lazy[0].check_stop_codon('A' * 30)
+    except AssertionError:
+        pass
+    else:
+        assert False
+    assert lazy[0].cds() == t1.cds() and lazy[1].cds() == t1.cds()
+    assert lazy[0]._mrna is None and len(seq_cache) == 1
+    assert lazy[0].premrna() == t1.premrna() and lazy[1]._mrna is None
+
+    # Gene store round trip
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    tmpdir = mkdtemp()
+    try:
+        store_dir = os.path.join(tmpdir, 'test.genes')
+        writer = GeneStoreWriter(store_dir)
+        writer.add({'gene': 'name1', 'tx': 'tx1', 'chrom': 'chr1',
+                    'tx_start': 1, 'tx_end': 23, 'strand': '-',
+                    'cds_start': 3, 'cds_end': 22, 'exon_starts': [1, 15],
+                    'exon_ends': [14, 23]}, 'AATTAGGGGGGAATAGGGCATT')
+        writer.close()
+        genes = StoredGenes(GeneStore(store_dir))
+        assert genes.keys() == ['name1'] and 'name2' not in genes
+        t2, = genes['name1']
+        assert t2.premrna() == t1.premrna()
+        assert t2.cds() == t1.cds()
+        assert t2.project_to_cds(16) == 6
+        assert genes.transcripts_by_accession('tx1') == [t2]
+        assert genes.transcripts_by_accession('tx2') == []
+        assert get_transcript(genes, 17, 'G', 'A', 'name1', 'tx1',
+                              get_accession_index(genes)) is t2
+        assert get_transcript_from_protein(genes, 'name1', 2, 'P', 'C>T') == \
+            (t2, 'chr1', t2.project_from_cds(5), 'G', 'A')
+
+        # generate --all output formats agree
+        from gzip import GzipFile
+        from cStringIO import StringIO
+        from silva.sitetable import read_site_table
+        # and are sorted by position, the - strand tx's sites included
+        gene_txs = [('name1', t2), ('name2', t2)]
+        text = format_synonymous('chr1', 0, 0, gene_txs, 'text')
+        lines = [line.split('\t') for line in text.splitlines()]
+        assert lines and [(int(pos), gene) for chrom, pos, _, _, _, gene, _
+                          in lines] == sorted([(int(pos), gene)
+                                               for chrom, pos, _, _, _, gene, _
+                                               in lines])
+        blocks = format_synonymous('chr1', 0, 0, gene_txs, 'bgzip')
+        assert GzipFile(fileobj=StringIO(blocks + bgzf.EOF_BLOCK)).read() == text
+        assert format_synonymous('chr1', 0, 0, [], 'text') == ''
+        table_filename = os.path.join(tmpdir, 'test.sites')
+        with open(table_filename, 'wb') as ofp:
+            write_header(ofp, ['chr1'], ['name1', 'name2'], ['tx1', 'tx1'])
+            ofp.write(format_synonymous('chr1', 0, 0, gene_txs, 'binary'))
+        chroms, names, txs, sites = read_site_table(table_filename)
+        assert ['%s\t%d\t.\t%s\t%s\t%s\t%s\n' %
+                (chroms[site['chrom']], site['pos'], site['ref'], site['alt'],
+                 names[site['tx']], txs[site['tx']]) for site in sites] == \
+            text.splitlines(True)
+
+        # A single preprocess pass writes what the separate steps of
+        # silva-preprocess do (filter, 1000gp.py, the AF filter, annotate)
+        def stdout_of(func, *args, **kwargs):
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                func(*args, **kwargs)
+                return sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+
+        def path(name):
+            return os.path.join(tmpdir, name)
+
+        tx = Transcript('name1', 'tx1', '1', 1, 23, '-', 3, 22, [1, 15],
+                        [14, 23], seq=seq('AAATTAGGGGGGAATAGGGCATTCCCCCCC'))
+        pre_genes = {'name1': [tx]}
+        positions, refs, alts = synonymous_sites(tx)
+        vcf = ['#CHROM\tPOS\tID\tREF\tALT\tQUAL\tINFO']
+        af_table = {'1': {}}
+        afs = [0.0, 0.05, 0.5, None, 0.0501]
+        for i, (pos, ref, alt) in enumerate(zip(positions, refs, alts)):
+            vcf.append('chr1\t%d\trs%d\t%s\t%s\t50\tDP=%d' %
+                       (pos, i, ref, alt, i))
+            if afs[i % len(afs)] is not None:
+                af_table['1'][(pos, alt)] = afs[i % len(afs)]
+        vcf.append('chr1\t2\trs-1\tA\tC\t50\t.')  # Not in the CDS
+        with open(path('in.vcf'), 'w') as ofp:
+            ofp.write('\n'.join(vcf) + '\n')
+
+        syn = stdout_of(filter_variants, pre_genes, path('in.vcf'))
+        af = ['#1000GP_AF']
+        flt = []
+        for line in syn.splitlines():
+            if line.startswith('#'):
+                flt.append(line)
+                continue
+            chrom, pos, id, ref, alt = split_fields(line, 5)[0]
+            af.append(format_af(af_table, chrom, pos, alt))
+            if af_in_range(af[-1], 0, 0.05):
+                flt.append(line)
+        with open(path('in.flt'), 'w') as ofp:
+            ofp.write('\n'.join(flt) + '\n')
+        mrna = stdout_of(annotate_variants, pre_genes, path('in.flt'))
+        assert 0 < len(flt) - 1 < len(af) - 1
+
+        for jobs in [1, 2]:
+            assert stdout_of(preprocess_variants, pre_genes, path('in.vcf'),
+                             af_table, af_min=0, af_max=0.05,
+                             syn_filename=path('pre.syn'),
+                             af_filename=path('pre.af'),
+                             flt_filename=path('pre.flt'), jobs=jobs) == mrna
+            assert open(path('pre.syn')).read() == syn
+            assert open(path('pre.af')).read().splitlines() == af
+            assert open(path('pre.flt')).read().splitlines() == flt
+    finally:
+        rmtree(tmpdir)
+
 def parse_args(args):
     from optparse import OptionParser
     usage = "usage: %prog [options] ACTION (VARIANTS|-)"
@@ -797,7 +1866,9 @@ def parse_args(args):
                           description=description)
     parser.add_option("-O", "--cache-genes", metavar="FILE",
                       dest="cache_filename", default=None,
-                      help="Read/write parsed genes to speed up re-runs")
+                      help="Read/write parsed genes to speed up re-runs:"
+                      " a memory-mapped gene store directory, or a pickled"
+                      " file if FILE ends with .pkl")
     parser.add_option("-g", "--genes", metavar="UCSC",
                       dest="gene_filename", default=None,
                       help="Read genes from UCSC file, unless cache already"
@@ -805,13 +1876,38 @@ def parse_args(args):
     parser.add_option("-G", "--genome", metavar="2BIT",
                       dest="genome_filename", default=None,
                       help="Extract sequence data from 2bit file (same assembly as --genes)")
+    parser.add_option("--lazy-seq", action="store_true",
+                      dest="lazy_seq", default=False,
+                      help="If genes are not cached, read each transcript's"
+                      " sequence from --genome only when it is first needed")
+    parser.add_option("--max-seqs", metavar="N", type="int",
+                      dest="max_seqs", default=5000,
+                      help="Keep the sequence of at most N lazily-read"
+                      " transcripts in memory at once (default: %default;"
+                      " 0 for no limit)")
     parser.add_option("--protein-coords", action="store_true",
                       dest="protein_coords", default=False,
                       help="If ACTION is 'filter', VARIANTS file contains"
                       " protein coordinates, not chromosomal coordinates")
+    parser.add_option("--sorted", action="store_true",
+                      dest="sorted_input", default=False,
+                      help="If ACTION is 'filter', VARIANTS are sorted by"
+                      " chromosome and position, so are streamed alongside"
+                      " the sorted CDS (indexed lookups are used if not)")
+    parser.add_option("-j", "--jobs", metavar="N", type="int",
+                      dest="jobs", default=1,
+                      help="If ACTION is 'filter', filter VARIANTS in chunks"
+                      " with N processes; with 'generate --all', process"
+                      " chromosomes with N processes (default: %default)")
     parser.add_option("--all", action="store_true",
                       dest="all", default=False,
                       help="Print all synonymous variants.")
+    parser.add_option("--format", metavar="FORMAT", type="choice",
+                      choices=['text', 'bgzip', 'binary'],
+                      dest="output_format", default='text',
+                      help="Print --all variants as 'text', BGZF-compressed"
+                      " text ('bgzip'), or a 'binary' site table (see"
+                      " silva.sitetable) (default: %default)")
     parser.add_option("--random", action="store_true",
                       dest="random", default=False,
                       help="Generate random synonymous variants.")
@@ -822,6 +1918,51 @@ def parse_args(args):
                       dest="avoid_splice", default=False,
                       help="Random variants will not be within 3bp of"
                       " annotated splice sites.")
+    parser.add_option("--seed", metavar="N", type="int",
+                      dest="seed", default=None,
+                      help="Seed the random number generator, so that"
+                      " --random variants are reproducible.")
+    parser.add_option("--full-context", action="store_true",
+                      dest="full_context", default=False,
+                      help="If ACTION is 'annotate', print the entire"
+                      " pre-mRNA of each variant's transcript, instead of"
+                      " only the sequence around the variant.")
+    parser.add_option("--af-table", metavar="VCF",
+                      dest="af_filename", default=None,
+                      help="If ACTION is 'preprocess', read allele"
+                      " frequencies from VCF (as 1000gp.py)")
+    parser.add_option("--af-cache", metavar="PKL",
+                      dest="af_cache", default=None,
+                      help="Read/write the parsed --af-table to PKL")
+    parser.add_option("--af-min", metavar="AF", type="float",
+                      dest="af_min", default=0.0,
+                      help="Drop variants with a lower allele frequency"
+                      " (default: %default)")
+    parser.add_option("--af-max", metavar="AF", type="float",
+                      dest="af_max", default=1.0,
+                      help="Drop variants with a higher allele frequency"
+                      " (default: %default)")
+    parser.add_option("--exclude-chrom", metavar="CHROM", action="append",
+                      dest="exclude_chroms", default=[],
+                      help="If ACTION is 'preprocess', drop variants on"
+                      " CHROM (may be repeated)")
+    parser.add_option("--syn-out", metavar="FILE",
+                      dest="syn_out", default=None,
+                      help="If ACTION is 'preprocess', also write the"
+                      " synonymous variants (as 'filter') to FILE")
+    parser.add_option("--af-out", metavar="FILE",
+                      dest="af_out", default=None,
+                      help="If ACTION is 'preprocess', also write the allele"
+                      " frequencies of those variants (as 1000gp.py) to FILE")
+    parser.add_option("--flt-out", metavar="FILE",
+                      dest="flt_out", default=None,
+                      help="If ACTION is 'preprocess', also write those of"
+                      " the variants with allele frequencies in range to FILE")
+    parser.add_option("--payload", metavar="FILE",
+                      dest="payload_filename", default=None,
+                      help="If ACTION is 'filter' or 'preprocess', write the"
+                      " VCF columns after alt to the side file FILE (and"
+                      " FILE.idx.npy), printing the record number instead")
     parser.add_option("--test", action="store_true", dest="run_tests")
     options, args = parser.parse_args()
 
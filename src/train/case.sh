@@ -31,12 +31,12 @@ mat=$base.mat
 
 if [[ ! -s $flt ]]; then
     echo "Filtering and annotating variants: $flt" >&2
-    ./src/input/synonymous.py --protein-coords -O data/refGene.pkl filter $pcoord > $flt
+    ./src/input/synonymous.py --protein-coords -O data/refGene.genes filter $pcoord > $flt
 fi
 
 if [[ ! -s $mrna ]]; then
     echo "Creating mRNA annotations: $mrna" >&2
-    ./src/input/synonymous.py -O data/refGene.pkl annotate $flt > $mrna
+    ./src/input/synonymous.py -O data/refGene.genes annotate $flt > $mrna
 fi
 
 if [[ ! -s $mat ]]; then
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 """
-Input sequences are read, one per line, of the form: GGAG|AAGA[C/G]TCG.
+Input sequences are read, one per line, of the form: GGAG|AAGA[C/G]TCG,
+or as compact contexts (see silva.context).
 Prints splicing-related numbers. Mutation must be in exon.
 """
 
@@ -13,6 +14,11 @@ from __future__ import division, with_statement
 import os
 import sys
 
+assert os.getenv('SILVA_PATH') is not None, \
+       "Error: SILVA_PATH is unset."
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva.context import MutationContext
+
 def nice_open(filename):
     if filename == '-':
         return sys.stdin
@@ -25,24 +31,9 @@ def script(filename, quiet=False, verbose=False, **kwargs):
     with nice_open(filename) as ifp:
         for line in ifp:
             line = line.strip().upper()
-            assert line.count('/') == 1
-
-            pre, post = line.split('/')
-            # Trim off mutation nucs and brackets
-            pre = pre[:-2]  # e,g, '[A'
-            post = post[2:]  # e.g. 'C]'
 
-            pre_chunks = pre.split('|')
-            post_chunks = post.split('|')
             # Assume mutation is in exon
-
-            premrna_f = min(len(pre), len(post)) \
-                           / (len(pre) + len(post) + 1)
-            pre_cds = ''.join(pre_chunks[::2])
-            post_cds = ''.join(post_chunks[::2])
-            mrna_f = min(len(pre_cds), len(post_cds)) \
-                        / (len(pre_cds) + len(post_cds) + 1)
-            splice_dist = min(len(pre_chunks[-1]), len(post_chunks[0]))
+            splice_dist = min(MutationContext.parse(line).block_lengths())
 
             print '%d' % splice_dist
 
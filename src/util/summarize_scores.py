@@ -1,58 +1,89 @@
 #!/usr/bin/env python
 
 """
-Usage: $0 FILE SCORED...
+Usage: $0 [--payload=PAYLOAD [--samples=DIR]] FILE SCORED...
 
 FILE has variants, one per line.
 Each SCORED file has a score, one per variant in FILE.
+PAYLOAD is the side file written by 'synonymous.py filter --payload', in
+which case the payload of each variant is put back in place of its
+'payload' column.
+
+With --samples, the payload must include the genotypes of a multi-sample
+VCF, and a ranked list is also written for each sample, to DIR/SAMPLE.txt:
+the variants it carries (the alt allele, in any genotype), ranked among
+themselves, with just its own genotype column. The scores are those of
+the whole FILE, so features and models are run once for all samples.
 
 Reports ranked, annotated lines.
 """
 
 
+import os
 import sys
 import signal
 
 from collections import defaultdict
-from numpy import array, column_stack, median, argsort
+from numpy import array, column_stack, median, argsort, empty, flatnonzero, \
+    append, concatenate, repeat, asarray
 
 LOW_LABEL = "likely benign"
 MID_LABEL = "potentially pathogenic"
 MID_CUTOFF = 0.28
 HIGH_LABEL = "likely pathogenic"
 HIGH_CUTOFF = 0.48
+# Payload columns before the samples
+VCF_PAYLOAD_FIELDS = ['QUAL', 'FILTER', 'INFO', 'FORMAT']
 
-# The following two rank functions are used in place of scipy's rankdata,
-# in order to remove scipy as a dependency.
-# http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-def rank_simple(vector):
-    return sorted(range(len(vector)), key=vector.__getitem__)
-
+# Used in place of scipy's rankdata, in order to remove scipy as a
+# dependency: tied values are given the mean of their ranks (1-indexed)
 def rankdata(a):
+    a = asarray(a)
     n = len(a)
-    ivec=rank_simple(a)
-    svec=[a[rank] for rank in ivec]
-    sumranks = 0
-    dupcount = 0
-    newarray = [0]*n
-    for i in xrange(n):
-        sumranks += i
-        dupcount += 1
-        if i==n-1 or svec[i] != svec[i+1]:
-            averank = sumranks / float(dupcount) + 1
-            for j in xrange(i-dupcount+1,i+1):
-                newarray[ivec[j]] = averank
-                
-            sumranks = 0
-            dupcount = 0
-            
+    if n == 0:
+        return empty(0)
+    ivec = argsort(a, kind='mergesort')
+    svec = a[ivec]
+    ends = append(flatnonzero(svec[1:] != svec[:-1]), n - 1)
+    starts = concatenate([[0], ends[:-1] + 1])
+    newarray = empty(n)
+    newarray[ivec] = repeat((starts + ends) / 2.0 + 1, ends - starts + 1)
     return newarray
 
 
-args = sys.argv[1:]
-if len(args) < 2:
+def usage(status=1):
     print __doc__
-    sys.exit(1)
+    sys.exit(status)
+
+args = sys.argv[1:]
+payloads = None
+sample_dir = None
+while args and args[0].startswith('--'):
+    # --OPTION=VALUE or --OPTION VALUE
+    option, sep, value = args.pop(0).partition('=')
+    if option == '--help':
+        usage(0)
+    elif option not in ['--payload', '--samples']:
+        usage()
+    if not sep:
+        if not args:
+            usage()
+        value = args.pop(0)
+    if not value:
+        usage()
+
+    if option == '--payload':
+        assert os.getenv('SILVA_PATH') is not None, \
+               "Error: SILVA_PATH is unset."
+        sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+        from silva.payload import PayloadReader, PAYLOAD_FIELD
+        from silva.vcf import carriers
+        payloads = PayloadReader(value)
+    else:
+        sample_dir = value
+
+if len(args) < 2 or (sample_dir and not payloads):
+    usage()
 
 def read_scores(filename):
     scores = []
@@ -62,51 +93,130 @@ def read_scores(filename):
     # Rank the negated scores
     return array(scores)
 
+def combine_scores(scores_list):
+    """Return the combined score, and its rank, of each variant, given the
+    scores of each model
+    """
+    ranks = column_stack([rankdata(-scores) for scores in scores_list])
+
+    #scores = ranks.shape[1]/(1/ranks).sum(axis=1)  # Harmonic mean rank
+    #scores = ranks.mean(axis=1)  # Mean rank
+    #Use score if there's only one, else use MRR
+    if len(scores_list) > 1:
+        scores = (1/ranks).sum(axis=1)/ranks.shape[1]  # Mean reciprocal rank
+    else:
+        scores = scores_list[0]
+
+    return scores, rankdata(-scores)
+
+def print_ranked(scores, ranks, lines, ofp=sys.stdout):
+    """Print lines from highest to lowest score"""
+    order = argsort(-scores)
+    assert len(lines) == len(order)
+    for i in order:
+        score, rank, line = scores[i], ranks[i], lines[i]
+        cls = LOW_LABEL
+        if score >= HIGH_CUTOFF:
+            cls = HIGH_LABEL
+        elif score >= MID_CUTOFF:
+            cls = MID_LABEL
+
+        rank = '%.1f' % rank
+        rank = rank[:-2] if rank.endswith('.0') else rank
+        print >>ofp, '\t'.join([rank, '%.3f' % score, cls, line])
+
+def print_sample_lists(sample_dir, header, rows, payload_col, scores_list):
+    """Write the ranked variants carried by each sample to sample_dir
+
+    header: the output columns, with the payload columns as one string
+    rows: (tokens, payload) of each variant, tokens having the payload
+      as one string (at payload_col), payload being split into fields
+    """
+    columns = (payloads.columns or '').split('\t')
+    assert columns[:len(VCF_PAYLOAD_FIELDS)] == VCF_PAYLOAD_FIELDS, \
+        "Error: expected VCF genotype columns in payload"
+    samples = columns[len(VCF_PAYLOAD_FIELDS):]
+
+    # Genotype matrix: a row per variant, a column per sample
+    n_fixed = len(VCF_PAYLOAD_FIELDS)
+    formats = [payload[n_fixed - 1] if len(payload) >= n_fixed else ''
+               for tokens, payload in rows]
+    genotypes = empty((len(rows), len(samples)), dtype=object)
+    genotypes[:] = '.'
+    for i, (tokens, payload) in enumerate(rows):
+        sample_fields = payload[n_fixed:n_fixed + len(samples)]
+        genotypes[i, :len(sample_fields)] = sample_fields
+    genotypes = genotypes.astype(str)
+    carried = carriers(formats, genotypes)
+
+    # Lines without the samples, to which that of one is added
+    before = ['\t'.join(tokens[:payload_col] + payload[:n_fixed])
+              for tokens, payload in rows]
+    after = ['\t'.join(tokens[payload_col + 1:]) for tokens, payload in rows]
+    scores_list = [array(scores) for scores in scores_list]
+
+    if not os.path.isdir(sample_dir):
+        os.makedirs(sample_dir)
+    for j, sample in enumerate(samples):
+        indexes = flatnonzero(carried[:, j])
+        scores, ranks = combine_scores([scores[indexes]
+                                        for scores in scores_list])
+        lines = ['\t'.join(filter(None, [before[i], genotypes[i, j],
+                                          after[i]]))
+                 for i in indexes]
+        with open(os.path.join(sample_dir, '%s.txt' % sample), 'w') as ofp:
+            print >>ofp, '#%s' % '\t'.join(
+                ["rank", "score", "class"] + header[:payload_col] +
+                VCF_PAYLOAD_FIELDS + [sample] + header[payload_col + 1:])
+            print_ranked(scores, ranks, lines, ofp)
+
+    print >>sys.stderr, "Wrote ranked variants of %d samples to: %s" % \
+        (len(samples), sample_dir)
+
 file = args[0]
 scored = args[1:]
 
-ranks_list = []
-for filename in scored:
-    scores = read_scores(filename)
-    ranks_list.append(rankdata(-scores))
-    
-ranks = column_stack(ranks_list)
-
-#scores = ranks.shape[1]/(1/ranks).sum(axis=1)  # Harmonic mean rank
-#scores = ranks.mean(axis=1)  # Mean rank
-#Use score if there's only one, else use MRR
-if len(scored) > 1:
-    scores = (1/ranks).sum(axis=1)/ranks.shape[1]  # Mean reciprocal rank
-
-order = argsort(-scores)
-ranks = rankdata(-scores)
+scores_list = [read_scores(filename) for filename in scored]
+scores, ranks = combine_scores(scores_list)
 
+header = None
 lines = []
+rows = []
+payload_col = None
 with open(file) as ifp:
     for line in ifp:
         line = line.strip()
         # Reorder gene and tx columns to the front, as hack until
         # internal file formats can be cleaned up
         tokens = line.lstrip('#').split('\t')
+        if payloads:
+            # Rejoin the payload (or its column names) stripped by filter
+            if line.startswith('#'):
+                payload_col = tokens.index(PAYLOAD_FIELD)
+                payload = payloads.columns
+            else:
+                payload = payloads.get(tokens[payload_col])
+                if payload is None and payloads.columns is not None:
+                    # Keep the columns aligned with the header
+                    payload = '\t'.join(['.'] *
+                                         len(payloads.columns.split('\t')))
+            if payload is None:
+                del tokens[payload_col]
+            else:
+                tokens[payload_col] = payload
         tokens = tokens[5:7] + tokens[:5] + tokens[7:]
         if line.startswith('#'):
+            header = tokens
             print "#%s" % '\t'.join(["rank", "score", "class"] + tokens)
         else:
             lines.append('\t'.join(tokens))
-
-assert len(lines) == len(order)
+            if sample_dir:
+                rows.append((tokens, (payload or '').split('\t')))
 
 # Treat SIGPIPE as Unix would expect
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-for i in order:
-    score, rank, line = scores[i], ranks[i], lines[i]
-    cls = LOW_LABEL
-    if score >= HIGH_CUTOFF:
-        cls = HIGH_LABEL
-    elif score >= MID_CUTOFF:
-        cls = MID_LABEL
-
-    rank = '%.1f' % rank
-    rank = rank[:-2] if rank.endswith('.0') else rank
-    print '\t'.join([rank, '%.3f' % score, cls, line])
+print_ranked(scores, ranks, lines)
+sys.stdout.flush()
 
+if sample_dir:
+    print_sample_lists(sample_dir, header, rows, payload_col, scores_list)